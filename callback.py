@@ -0,0 +1,338 @@
+import io
+import os
+import os.path
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import traceback
+
+# MATLAB-side plumbing.  matropylis_cb_call does the actual work of
+# shipping arguments to Python and reading the results back; each
+# registered callback gets a tiny shim that forwards to it.
+#
+# every message on either pipe is a little-endian uint64 byte count
+# followed by that many bytes.  requests are
+#
+#   uint32 name length, name, uint32 nargout, uint32 nargin, arrays...
+#
+# and responses are a uint8 status followed by either uint32 nargout and
+# that many arrays (status 0) or a UTF-8 error message (status 1).  an
+# array is
+#
+#   uint8 classID, uint8 is_complex, 2 bytes padding, uint32 ndims,
+#   uint64 dims[ndims], raw column-major data (real plane, then imag)
+#
+# chars travel as their UTF-16 code units and logicals as one byte each.
+_call_template = r"""function varargout = matropylis_cb_call(name, nout, varargin)
+%%MATROPYLIS_CB_CALL  Invoke a Python callback registered with matropylis.
+persistent req resp
+if isempty(req)
+  req = fopen('%(request_path)s', 'w');
+end
+
+chunks = cell(1, numel(varargin));
+for k = 1:numel(varargin)
+  chunks{k} = encode(varargin{k});
+end
+msg = [ typecast(uint32(numel(name)), 'uint8')'; uint8(name(:)); ...
+  typecast(uint32(nout), 'uint8')'; ...
+  typecast(uint32(numel(varargin)), 'uint8')'; vertcat(chunks{:}) ];
+fwrite(req, [ typecast(uint64(numel(msg)), 'uint8')'; msg ], 'uint8');
+if isempty(resp)
+  resp = fopen('%(response_path)s', 'r');
+end
+
+len = double(typecast(fread(resp, 8, '*uint8'), 'uint64'));
+buf = fread(resp, len, '*uint8');
+if buf(1) ~= 0
+  error('matropylis:callback', '%%s', native2unicode(buf(2:end)', 'UTF-8'));
+end
+count = double(typecast(buf(2:5), 'uint32'));
+pos = 6;
+varargout = cell(1, count);
+for k = 1:count
+  [varargout{k}, pos] = decode(buf, pos);
+end
+
+function bytes = encode(x)
+ids = struct('double', 6, 'single', 7, 'int8', 8, 'uint8', 9, ...
+  'int16', 10, 'uint16', 11, 'int32', 12, 'uint32', 13, 'int64', 14, ...
+  'uint64', 15);
+if ischar(x)
+  id = 4; x = uint16(x);
+elseif islogical(x)
+  id = 3; x = uint8(x);
+elseif isnumeric(x) && isfield(ids, class(x))
+  id = ids.(class(x));
+else
+  error('matropylis:callback', 'can''t send a %%s to Python', class(x));
+end
+cplx = ~isreal(x);
+if cplx
+  data = [ typecast(reshape(real(x), [], 1), 'uint8'); ...
+    typecast(reshape(imag(x), [], 1), 'uint8') ];
+else
+  data = typecast(reshape(x, [], 1), 'uint8');
+end
+sz = size(x);
+bytes = [ uint8([ id; cplx; 0; 0 ]); ...
+  typecast(uint32(numel(sz)), 'uint8')'; ...
+  typecast(uint64(sz(:)), 'uint8'); data ];
+
+function [x, pos] = decode(buf, pos)
+classes = { '', '', 'uint8', 'uint16', '', 'double', 'single', 'int8', ...
+  'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64', 'uint64' };
+widths = [ 0 0 1 2 0 8 4 1 1 2 2 4 4 8 8 ];
+id = double(buf(pos));
+cplx = buf(pos+1) ~= 0;
+nd = double(typecast(buf(pos+4:pos+7), 'uint32'));
+pos = pos + 8;
+sz = double(typecast(buf(pos:pos+8*nd-1), 'uint64'))';
+pos = pos + 8*nd;
+nbytes = prod(sz) * widths(id);
+x = typecast(buf(pos:pos+nbytes-1), classes{id});
+pos = pos + nbytes;
+if cplx
+  x = complex(x, typecast(buf(pos:pos+nbytes-1), classes{id}));
+  pos = pos + nbytes;
+end
+if id == 4
+  x = char(x);
+elseif id == 3
+  x = logical(x);
+end
+x = reshape(x, sz);
+"""
+
+_shim_template = r"""function varargout = %(name)s(varargin)
+%%%(upper_name)s  Python callback registered with matropylis.
+if nargout == 0
+  matropylis_cb_call('%(name)s', 0, varargin{:});
+else
+  varargout = cell(1, nargout);
+  [varargout{:}] = matropylis_cb_call('%(name)s', nargout, varargin{:});
+end
+"""
+
+class callback_server(object):
+  def __init__(self, api):
+    """Serve Python callables to MATLAB.
+
+    MATLAB talks to the server through a pair of named pipes in a
+    private temporary directory, which also holds the generated .m
+    shims; add that directory to the MATLAB path to use the callbacks.
+    A reader thread pulls requests off the pipe and runs each callback
+    itself: MATLAB waits for every reply before sending anything else,
+    so there's nothing to run concurrently.
+
+    Callbacks run while the engine is blocked in eval, so they must not
+    use the engine themselves.
+
+    """
+    self.api = api
+    self.directory = tempfile.mkdtemp(prefix="matropylis")
+    self.request_path = os.path.join(self.directory, "request")
+    self.response_path = os.path.join(self.directory, "response")
+    os.mkfifo(self.request_path)
+    os.mkfifo(self.response_path)
+
+    self.__write_m_file("matropylis_cb_call", _call_template % \
+        { "request_path" : self.request_path,
+          "response_path" : self.response_path })
+
+    self.__callbacks = {}
+    self.__closing = False
+    self.__thread = threading.Thread(target=self.__serve)
+    self.__thread.daemon = True
+    self.__thread.start()
+
+  def register(self, name, func):
+    if re.match(r"^[A-Za-z][A-Za-z0-9_]*$", name) is None:
+      raise ValueError("'%s' isn't a valid MATLAB function name" % name)
+    self.__callbacks[name] = func
+    self.__write_m_file(name, _shim_template % \
+        { "name" : name, "upper_name" : name.upper() })
+
+  def close(self):
+    if self.__closing:
+      return
+    self.__closing = True
+
+    # a zero-length message wakes up the reader thread and tells it to
+    # stop, whether it's waiting for MATLAB to connect or for a request
+    try:
+      fd = os.open(self.request_path, os.O_WRONLY | os.O_NONBLOCK)
+      try:
+        os.write(fd, struct.pack("<Q", 0))
+      finally:
+        os.close(fd)
+    except OSError:
+      # nobody is reading, so the reader thread is already gone
+      pass
+    self.__thread.join(1.0)
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def __write_m_file(self, name, source):
+    path = os.path.join(self.directory, "%s.m" % name)
+    with open(path, "w") as f:
+      f.write(source)
+
+  def __serve(self):
+    while not self.__closing:
+      # opening a pipe blocks until the other end shows up.  MATLAB
+      # opens the response pipe only after its first request is written,
+      # so we read that request in full before opening ours.
+      req = io.open(self.request_path, "rb", buffering=0)
+      resp = None
+      try:
+        while True:
+          header = _read_exact(req, 8)
+          if header is None:
+            # MATLAB went away; wait for it to reconnect
+            break
+          (length,) = struct.unpack("<Q", header)
+          if length == 0:
+            return
+          message = _read_exact(req, length)
+          if resp is None:
+            resp = io.open(self.response_path, "wb", buffering=0)
+          try:
+            reply = self.__handle(message)
+          except BaseException:
+            # MATLAB is blocked until it gets a reply, so it gets one no
+            # matter what went wrong, and the thread keeps going
+            reply = _error_reply(traceback.format_exc())
+          resp.write(struct.pack("<Q", len(reply)))
+          resp.write(reply)
+      finally:
+        req.close()
+        if resp is not None:
+          resp.close()
+
+  def __handle(self, message):
+    try:
+      (name_len,) = struct.unpack_from("<I", message, 0)
+      name = str(message[4:4+name_len])
+      pos = 4 + name_len
+      (nargout, nargin) = struct.unpack_from("<II", message, pos)
+      pos += 8
+
+      args = []
+      for i in xrange(nargin):
+        (arg, pos) = _decode_array(self.api, message, pos)
+        args.append(arg)
+
+      if name not in self.__callbacks:
+        raise NameError("no Python callback named '%s'" % name)
+      result = self.__callbacks[name](*args)
+
+      if nargout == 0:
+        results = []
+      elif nargout == 1:
+        results = [ result ]
+      else:
+        results = list(result)
+        if len(results) < nargout:
+          raise ValueError("%s returned %d outputs, %d requested" % \
+              (name, len(results), nargout))
+        results = results[:nargout]
+
+      chunks = [ struct.pack("<BI", 0, len(results)) ]
+      for r in results:
+        chunks.extend(_encode_array(self.api, r))
+      return "".join(chunks)
+    except Exception:
+      return _error_reply(traceback.format_exc())
+
+def _error_reply(text):
+  # exception messages are often byte strings in no particular encoding,
+  # so anything that isn't UTF-8 is replaced rather than raising
+  if not isinstance(text, unicode):
+    text = text.decode("utf-8", "replace")
+  return struct.pack("<B", 1) + text.encode("utf-8")
+
+def _read_exact(f, num_bytes):
+  # reads on a pipe can come up short, so keep going until we have it
+  # all.  returns None on a clean EOF between messages.
+  buf = bytearray(num_bytes)
+  view = memoryview(buf)
+  got = 0
+  while got < num_bytes:
+    n = f.readinto(view[got:])
+    if not n:
+      if got == 0:
+        return None
+      raise IOError("callback pipe closed mid-message")
+    got += n
+  return buf
+
+def _decode_array(api, message, pos):
+  import numpy as np
+  (classID, is_complex, ndim) = struct.unpack_from("<BBxxI", message, pos)
+  pos += 8
+  dims = struct.unpack_from("<%dQ" % ndim, message, pos)
+  pos += 8 * ndim
+  count = reduce(lambda x,y:x*y, dims, 1)
+
+  if classID == api.mxCHAR_CLASS:
+    dtype = np.dtype(np.uint16)
+  else:
+    dtype = np.dtype(api.classID_to_dtype(classID))
+
+  # these are views onto the message buffer; no copy for real data
+  real = np.frombuffer(message, dtype, count, pos).reshape(dims, order="F")
+  pos += count * dtype.itemsize
+  if is_complex:
+    imag = np.frombuffer(message, dtype, count, pos).reshape(dims,
+        order="F")
+    pos += count * dtype.itemsize
+    value = np.empty(dtype=np.result_type(dtype, np.complex64),
+        shape=dims, order="F")
+    value.real[...] = real
+    value.imag[...] = imag
+  else:
+    value = real
+
+  if classID == api.mxCHAR_CLASS:
+    rows = [ value[r, :].tostring().decode("utf-16-le").rstrip(" ") \
+        for r in xrange(value.shape[0]) ]
+    if len(rows) <= 1:
+      return (rows[0] if rows else u"", pos)
+    return (np.array(rows), pos)
+
+  if value.size == 1:
+    return (value.flat[0], pos)
+  return (value, pos)
+
+def _encode_array(api, value):
+  import numpy as np
+  if isinstance(value, basestring):
+    codes = np.frombuffer(unicode(value).encode("utf-16-le"), np.uint16)
+    value = codes.reshape((1, codes.size))
+    classID = api.mxCHAR_CLASS
+  else:
+    if isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool):
+      # plain Python numbers are doubles as far as MATLAB is concerned
+      value = float(value)
+    value = np.asarray(value)
+    classID = api.dtype_to_classID(value.dtype)
+    if classID == api.mxLOGICAL_CLASS:
+      value = value.view(np.uint8)
+
+  if value.ndim == 0:
+    value = value.reshape((1, 1))
+  elif value.ndim == 1:
+    value = value.reshape((value.shape[0], 1))
+
+  is_complex = value.dtype.kind == "c"
+  chunks = [ struct.pack("<BBxxI", classID, is_complex, value.ndim),
+      struct.pack("<%dQ" % value.ndim, *value.shape) ]
+  if is_complex:
+    chunks.append(value.real.T.tostring())
+    chunks.append(value.imag.T.tostring())
+  else:
+    chunks.append(value.T.tostring())
+  return chunks
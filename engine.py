@@ -1,8 +1,42 @@
+import atexit
+import collections
 import ctypes as ct
 import os
 import os.path
+import re
+import shutil
+import tempfile
+import time
+import zlib
 
 class matlab(object):
+  # a few enumerations (optimistic guesses from the header files)
+
+  # mxComplexity
+  mxREAL = 0
+  mxCOMPLEX = 1
+
+  # mxClassID 
+  mxUNKNOWN_CLASS = 0
+  mxCELL_CLASS = 1
+  mxSTRUCT_CLASS = 2
+  mxLOGICAL_CLASS = 3
+  mxCHAR_CLASS = 4
+  mxVOID_CLASS = 5
+  mxDOUBLE_CLASS = 6
+  mxSINGLE_CLASS = 7
+  mxINT8_CLASS = 8
+  mxUINT8_CLASS = 9
+  mxINT16_CLASS = 10
+  mxUINT16_CLASS = 11
+  mxINT32_CLASS = 12
+  mxUINT32_CLASS = 13
+  mxINT64_CLASS = 14
+  mxUINT64_CLASS = 15
+  mxFUNCTION_CLASS = 16
+  mxOPAQUE_CLASS = 17
+  mxOBJECT_CLASS = 18
+
   def __init__(self, matlab_path):
     """Access the MATLAB C API.
 
@@ -16,41 +50,144 @@ class matlab(object):
 
     self.__setup_ctypes()
 
-    # define some helpers for conversion
+  # helpers for conversion.  these only depend on the enumerations
+  # above, so they're usable without a MATLAB install (e.g., from
+  # matfile.py)
+  __matlab2numpy = None
+  __numpy2matlab = None
+
+  @classmethod
+  def __conversion_tables(cls):
+    if cls.__matlab2numpy is None:
+      import numpy as np
+      cls.__matlab2numpy = { cls.mxLOGICAL_CLASS: ct.c_bool,
+          cls.mxCHAR_CLASS: ct.c_char,
+          cls.mxDOUBLE_CLASS: ct.c_double,
+          cls.mxSINGLE_CLASS: ct.c_float,
+          cls.mxINT8_CLASS: ct.c_int8,
+          cls.mxUINT8_CLASS: ct.c_uint8,
+          cls.mxINT16_CLASS: ct.c_int16,
+          cls.mxUINT16_CLASS: ct.c_uint16,
+          cls.mxINT32_CLASS: ct.c_int32,
+          cls.mxUINT32_CLASS: ct.c_uint32,
+          cls.mxINT64_CLASS: ct.c_int64,
+          cls.mxUINT64_CLASS: ct.c_uint64 }
+      cls.__numpy2matlab = { \
+          np.bool_ : cls.mxLOGICAL_CLASS,
+          np.double : cls.mxDOUBLE_CLASS,
+          np.float64 : cls.mxDOUBLE_CLASS,
+          np.float : cls.mxSINGLE_CLASS,
+          np.float32 : cls.mxSINGLE_CLASS,
+          np.single : cls.mxSINGLE_CLASS,
+          np.int8 : cls.mxINT8_CLASS,
+          np.uint8 : cls.mxUINT8_CLASS,
+          np.int16 : cls.mxINT16_CLASS,
+          np.uint16 : cls.mxUINT16_CLASS,
+          np.int32 : cls.mxINT32_CLASS,
+          np.uint32 : cls.mxUINT32_CLASS,
+          np.int64 : cls.mxINT64_CLASS,
+          np.uint64 : cls.mxUINT64_CLASS,
+          np.complex64 : cls.mxSINGLE_CLASS,
+          np.complex128 : cls.mxDOUBLE_CLASS }
+    return (cls.__matlab2numpy, cls.__numpy2matlab)
+
+  @classmethod
+  def classID_to_dtype(cls, classID):
+    return cls.__conversion_tables()[0][classID]
+
+  @classmethod
+  def dtype_to_classID(cls, dtype):
+    try:
+      return cls.__conversion_tables()[1][dtype.type]
+    except KeyError:
+      raise TypeError("no MATLAB class for dtype %s" % dtype)
+
+  @staticmethod
+  def scalar_array(value):
+    # scalars go across as 1x1 arrays, which keeps their full precision.
+    # booleans become logicals and every other number, numpy scalars
+    # included, becomes a (complex) double, as MATLAB would have it.
+    import numpy as np
+    if isinstance(value, (bool, np.bool_)):
+      return np.asarray(value, dtype=np.bool_)
+    if isinstance(value, np.generic) and value.dtype.kind not in "iufc":
+      # e.g., structured (np.void) scalars
+      return np.asarray(value)
+    if isinstance(value, (complex, np.complexfloating)):
+      return np.asarray(value, dtype=np.complex128)
+    return np.asarray(value, dtype=np.double)
+
+  @staticmethod
+  def strings_to_char_codes(value):
+    """Turn a string, a sequence of strings or an ndarray of strings into
+    a (rows, columns) uint32 array of UTF-16 code units, one string per
+    row, NUL-padded on the right.
+
+    """
+    import numpy as np
+    strings = np.asarray(value)
+    if strings.dtype.kind == "S":
+      strings = np.char.decode(strings, "utf-8")
+    strings = np.ascontiguousarray(strings, dtype=np.unicode_).reshape(-1)
+
+    # numpy stores unicode as UCS-4 code points, NUL-padded to the widest
+    # string, which is nearly what MATLAB wants already
+    num_rows = strings.size
+    if num_rows > 0:
+      num_cols = int(np.char.str_len(strings).max())
+      codes = strings.view(np.uint32).reshape(num_rows, -1)
+      codes = codes[:, :num_cols]
+    else:
+      codes = np.zeros(dtype=np.uint32, shape=(0, 0))
+    if (codes > 0xffff).any():
+      raise ValueError("MATLAB char arrays can't hold characters "
+          "outside the Basic Multilingual Plane")
+    return codes
+
+  @staticmethod
+  def char_matrix_to_python(chars, num_rows):
+    """Turn a (rows, columns) array of UTF-16 code units from a MATLAB char
+    matrix into a string (one row) or an ndarray of strings, stripping the
+    space padding.  chars may be None for an empty matrix.
+
+    """
     import numpy as np
-    self.__matlab2numpy = { self.mxLOGICAL_CLASS: ct.c_bool,
-        self.mxCHAR_CLASS: ct.c_char,
-        self.mxDOUBLE_CLASS: ct.c_double,
-        self.mxSINGLE_CLASS: ct.c_float,
-        self.mxINT8_CLASS: ct.c_int8,
-        self.mxUINT8_CLASS: ct.c_uint8,
-        self.mxINT16_CLASS: ct.c_int16,
-        self.mxUINT16_CLASS: ct.c_uint16,
-        self.mxINT32_CLASS: ct.c_int32,
-        self.mxUINT32_CLASS: ct.c_uint32,
-        self.mxINT64_CLASS: ct.c_int64,
-        self.mxUINT64_CLASS: ct.c_uint64 }
-    self.__numpy2matlab = { \
-        np.bool_ : self.mxLOGICAL_CLASS,
-        np.double : self.mxDOUBLE_CLASS,
-        np.float64 : self.mxDOUBLE_CLASS,
-        np.float : self.mxSINGLE_CLASS,
-        np.float32 : self.mxSINGLE_CLASS,
-        np.single : self.mxSINGLE_CLASS,
-        np.int8 : self.mxINT8_CLASS,
-        np.uint8 : self.mxUINT8_CLASS,
-        np.int16 : self.mxINT16_CLASS,
-        np.uint16 : self.mxUINT16_CLASS,
-        np.int32 : self.mxINT32_CLASS,
-        np.uint32 : self.mxUINT32_CLASS,
-        np.int64 : self.mxINT64_CLASS,
-        np.uint64 : self.mxUINT64_CLASS }
-
-  def classID_to_dtype(self, classID):
-    return self.__matlab2numpy[classID]
-
-  def dtype_to_classID(self, dtype):
-    return self.__numpy2matlab[dtype.type]
+    if chars is None or chars.size == 0:
+      to_ret = np.zeros(dtype=np.unicode_, shape=(num_rows,))
+    else:
+      # widen to the UCS-4 code points numpy uses, one C-ordered row per
+      # string
+      codes = np.array(chars, dtype=np.uint32, order="C")
+
+      # MATLAB pads rows with spaces; numpy pads with NULs.  find the
+      # trailing run of spaces in each row and turn it into padding.
+      padding = np.logical_and.accumulate(codes[:, ::-1] == ord(" "),
+          axis=1)[:, ::-1]
+      codes[padding] = 0
+
+      to_ret = codes.view(np.dtype((np.unicode_, codes.shape[1])))
+      to_ret = to_ret.reshape(num_rows)
+
+    if to_ret.shape[0] <= 1:
+      # just one string
+      if to_ret.shape[0] == 0:
+        return ""
+      try:
+        return str(to_ret[0])
+      except UnicodeEncodeError:
+        return unicode(to_ret[0])
+    else:
+      return to_ret
+
+  def interleaved_complex_data(self, array_ptr, classID):
+    """Address of the interleaved (re, im, re, im, ...) buffer of a
+    complex mxArray, or None if this MATLAB doesn't export the
+    interleaved-complex API for classID.
+
+    """
+    if classID not in self.__complex_getters:
+      return None
+    return self.__complex_getters[classID](array_ptr)
 
   def index_to_coords(self, dims, index):
     """Given an object with dimensions dims, and an index number, find
@@ -67,6 +204,29 @@ class matlab(object):
       div /= dims[d]
     return to_return
 
+  def as_ndarray(self, addr, dims, dtype, owner=None):
+    """Wrap the MATLAB-owned buffer at addr in a column-major ndarray.
+
+    No data is copied; the returned array aliases MATLAB memory, so it
+    must be copied (or written into) before the owning mxArray is
+    destroyed.  Alternatively, pass the mx_array_owner of that mxArray
+    as owner and the array will keep it alive.
+
+    """
+    import numpy as np
+    dtype = np.dtype(dtype)
+    dims = tuple(dims)
+    count = reduce(lambda x,y:x*y, dims, 1)
+    if count == 0:
+      return np.empty(dtype=dtype, shape=dims, order="F")
+    if owner is not None:
+      raw = np.asarray(mx_array_memory(addr, count * dtype.itemsize, owner))
+    else:
+      byte_ptr = ct.cast(addr, ct.POINTER(ct.c_uint8))
+      raw = np.ctypeslib.as_array(byte_ptr,
+          shape=(count * dtype.itemsize,))
+    return raw.view(dtype).reshape(dims, order="F")
+
   def __arch(self):
     mexext_path = os.path.sep.join( \
         ( self.matlab_path, "bin", "mexext" ) )
@@ -138,33 +298,6 @@ class matlab(object):
         "libmx.so" ) )
     self.__mx = ct.cdll.LoadLibrary(mx_dll_path)
 
-    # a few enumerations (optimistic guesses from the header files)
-
-    # mxComplexity
-    self.mxREAL = 0
-    self.mxCOMPLEX = 1
-
-    # mxClassID 
-    self.mxUNKNOWN_CLASS = 0
-    self.mxCELL_CLASS = 1
-    self.mxSTRUCT_CLASS = 2
-    self.mxLOGICAL_CLASS = 3
-    self.mxCHAR_CLASS = 4
-    self.mxVOID_CLASS = 5
-    self.mxDOUBLE_CLASS = 6
-    self.mxSINGLE_CLASS = 7
-    self.mxINT8_CLASS = 8
-    self.mxUINT8_CLASS = 9
-    self.mxINT16_CLASS = 10
-    self.mxUINT16_CLASS = 11
-    self.mxINT32_CLASS = 12
-    self.mxUINT32_CLASS = 13
-    self.mxINT64_CLASS = 14
-    self.mxUINT64_CLASS = 15
-    self.mxFUNCTION_CLASS = 16
-    self.mxOPAQUE_CLASS = 17
-    self.mxOBJECT_CLASS = 18
-
     # many, many function bindings
 
     self.mxIsComplex = self.__mx.mxIsComplex
@@ -463,10 +596,62 @@ class matlab(object):
     self.mxSetProperty.argtypes = [ ct.c_void_p, ct.c_size_t,
         ct.c_char_p, ct.c_void_p ]
 
+    # the interleaved-complex API only exists in newer MATLABs, and
+    # depending on the release it's exported with or without a version
+    # suffix.  bind whatever we can find; callers fall back to the
+    # split real/imag planes when a getter is missing.
+    self.__complex_getters = {}
+    for (classID, names) in [ \
+        (self.mxDOUBLE_CLASS,
+          ("mxGetComplexDoubles_800", "mxGetComplexDoubles")),
+        (self.mxSINGLE_CLASS,
+          ("mxGetComplexSingles_800", "mxGetComplexSingles")) ]:
+      for func_name in names:
+        try:
+          func = getattr(self.__mx, func_name)
+        except AttributeError:
+          continue
+        func.restype = ct.c_void_p
+        func.argtypes = [ ct.c_void_p ]
+        func.errcheck = self.__result_check( \
+            lambda x: x != 0 )
+        self.__complex_getters[classID] = func
+        break
+    self.has_interleaved_complex = len(self.__complex_getters) > 0
+
+class mx_array_owner(object):
+  def __init__(self, api, array_ptr):
+    """Destroys the mxArray at array_ptr once nothing refers to this.
+
+    Zero-copy arrays made by matlab.as_ndarray with an owner keep a
+    reference to it, so MATLAB memory lives exactly as long as the
+    arrays that alias it.
+
+    """
+    self.api = api
+    self.array_ptr = array_ptr
+
+  def __del__(self):
+    if self.array_ptr is not None and self.array_ptr != 0:
+      self.api.mxDestroyArray(self.array_ptr)
+      self.array_ptr = None
+
+class mx_array_memory(object):
+  # a raw block of mxArray memory for numpy to wrap.  the ndarray's base
+  # is this object, which in turn holds on to the owner.
+  def __init__(self, addr, num_bytes, owner):
+    self.owner = owner
+    self.__array_interface__ = { "data" : (addr, False),
+        "shape" : (num_bytes,), "typestr" : "|u1", "version" : 3 }
+
 class engine_function_proxy(object):
-  def __init__(self, engine, name, docs="", is_handle=False):
+  def __init__(self, engine, name, docs="", is_handle=False,
+      proxy=None):
     self.engine = engine
     self.name = name
+    # the engine_object_proxy whose variable name is part of name, e.g.
+    # the strum behind a strum method; it's kept resident across calls
+    self.proxy = proxy
     self.is_handle = is_handle
     self.docs = docs
     self.__doc__ = self.docs
@@ -507,6 +692,10 @@ class engine_function_proxy(object):
     to infer the number of output arguments via bytecode introspection,
     but this has been known to fail from time to time.
 
+    The optional keyword argument "outs" is a list with one entry per
+    output; each entry is either None or a preallocated ndarray that the
+    corresponding output is decoded into (see engine.get_variable).
+
     """
     nargout = None
     if "nargout" in kwargs.keys():
@@ -514,15 +703,29 @@ class engine_function_proxy(object):
     else:
       nargout = self.__expecting()
 
+    profile = self.engine.call_profile
+    if profile is not None:
+      start_time = time.time()
+
     # copy over non-proxy objects; use proxy objects as expected
     var_names = []
+    proxy_names = []
     for arg in args:
-      if hasattr(arg, "matlab_name"):
+      if isinstance(arg, engine_object_proxy):
+        # brought back all at once below
+        var_names.append(arg.workspace_name)
+        proxy_names.append(arg.workspace_name)
+      elif hasattr(arg, "matlab_name"):
         var_names.append(arg.matlab_name)
       else:
         temp_name = self.engine.temp_name()
         var_names.append(temp_name)
         self.engine.set_variable(temp_name, arg)
+    if self.proxy is not None:
+      proxy_names.append(self.proxy.workspace_name)
+    # reloading one spilled argument mustn't evict another, or the
+    # variable we're calling through
+    self.engine.ensure_resident(*proxy_names)
 
     # get a list of temporary names for the return values
     out_names = [ self.engine.temp_name() for i in xrange(nargout) ]
@@ -535,7 +738,19 @@ class engine_function_proxy(object):
       eval_str =  "[%s] = %s(%s);" % (out_names_str, self.name, in_names_str)
     else:
       eval_str = "%s(%s);" % (self.name, in_names_str)
+    if profile is not None:
+      # time the call from inside MATLAB too, so we can tell compute
+      # from engine overhead
+      time_name = self.engine.temp_name()
+      eval_str = "%s = tic; %s %s = toc(%s);" % (time_name, eval_str,
+          time_name, time_name)
+      push_time = time.time()
     self.engine(eval_str)
+    if profile is not None:
+      eval_time = time.time()
+      matlab_time = self.engine.get_plain_variable(time_name)
+      self.engine("clear %s;" % time_name)
+      fetch_start_time = time.time()
 
     # get results from MATLAB and return
     to_return = None
@@ -543,8 +758,18 @@ class engine_function_proxy(object):
       to_return = tuple([ self.engine.get_proxy(argname) \
           for argname in out_names ])
     else:
-      to_return = tuple([ self.engine.get_variable(argname) \
-          for argname in out_names ])
+      outs = kwargs.get("outs", None)
+      if outs is None:
+        outs = [ None ] * nargout
+      elif len(outs) != nargout:
+        raise ValueError("got %d output buffers for %d outputs" % \
+            (len(outs), nargout))
+      to_return = tuple([ self.engine.get_variable(argname, out=out) \
+          for (argname, out) in zip(out_names, outs) ])
+    if profile is not None:
+      profile.record(self.name, push_time - start_time, matlab_time,
+          max(eval_time - push_time - matlab_time, 0.0),
+          time.time() - fetch_start_time)
     if nargout == 0:
       return
     elif nargout == 1:
@@ -552,26 +777,307 @@ class engine_function_proxy(object):
     else:
       return to_return
 
+  def map(self, arg_sets, uniform=True, nargout=1):
+    """Call the function once per entry of arg_sets in one round trip.
+
+    Each entry of arg_sets is a tuple of arguments; anything else is
+    taken as a single argument.  All the argument sets go across as one
+    cell array, the calls are made by a single cellfun, and the outputs
+    come back in one transfer.
+
+    With uniform, every call must return scalars, and each output is a
+    1-d ndarray with one entry per call.  Otherwise each output is a
+    list of whatever the calls returned.  For nargout > 1, a tuple of
+    nargout such outputs is returned.
+
+    """
+    import numpy as np
+    arg_sets = [ a if isinstance(a, tuple) else (a,) for a in arg_sets ]
+    num_calls = len(arg_sets)
+    num_args = len(arg_sets[0]) if num_calls > 0 else 1
+    if num_args == 0:
+      raise ValueError("map needs at least one argument per call")
+    for a in arg_sets:
+      if len(a) != num_args:
+        raise ValueError("all argument sets must be the same length")
+
+    if num_calls == 0:
+      to_return = [ np.empty((0,)) if uniform else [] \
+          for i in xrange(nargout) ]
+    else:
+      # one row per call, one column per argument
+      cells = np.empty(dtype=object, shape=(num_calls, num_args))
+      for (i, a) in enumerate(arg_sets):
+        for (j, arg) in enumerate(a):
+          cells[i, j] = arg
+      cells_name = self.engine.temp_name()
+      self.engine.set_variable(cells_name, cells)
+
+      if not self.is_handle:
+        func = "@%s" % self.name
+      elif re.match(r"^[A-Za-z]\w*$", self.name):
+        func = self.name
+      else:
+        # e.g., a strum method; cellfun needs an actual handle
+        func = "@(varargin) %s(varargin{:})" % self.name
+
+      out_names = [ self.engine.temp_name() for i in xrange(nargout) ]
+      if self.proxy is not None:
+        self.engine.ensure_resident(self.proxy.workspace_name)
+      self.engine("[%s] = cellfun(%s, %s, 'UniformOutput', %s); " \
+          "clear %s;" % (", ".join(out_names), func,
+            ", ".join([ "%s(:, %d)" % (cells_name, j+1) \
+                for j in xrange(num_args) ]),
+            "true" if uniform else "false", cells_name))
+
+      to_return = self.engine.get_variables(out_names)
+      self.engine("clear %s;" % " ".join(out_names))
+      if uniform:
+        to_return = [ np.ravel(np.asarray(out)) for out in to_return ]
+      else:
+        to_return = [ list(np.ravel(out)) for out in to_return ]
+
+    if nargout == 1:
+      return to_return[0]
+    return tuple(to_return)
+
 class engine_object_proxy(object):
   def __init__(self, engine, matlab_name):
     self.__engine = engine
     self.__matlab_name = matlab_name
 
   def get(self):
-    return self.__engine.get_variable(self.__matlab_name)
-
-  def __get_matlab_name(self): return self.__matlab_name
+    return self.__engine.get_variable(self.matlab_name)
+
+  def __get_matlab_name(self):
+    # every use of a proxy goes through here, which lets the engine keep
+    # its LRU order and bring back spilled variables
+    self.__engine.ensure_resident(self.__matlab_name)
+    return self.__matlab_name
+
+  def __get_workspace_name(self):
+    # the name alone, for callers that call ensure_resident themselves
+    return self.__matlab_name
+  workspace_name = property(__get_workspace_name)
   matlab_name = property(__get_matlab_name)
 
+class strum(object):
+  def __init__(self, engine, strum_proxy):
+    """A MATLAB strum that stays in the workspace.
+
+    Data fields are fetched on first access and cached; method calls go
+    through the strum's own subsref on strum_proxy, so the strum is
+    never copied back and forth.  The engine builds one subclass per set
+    of method and data names with a property or method for each.
+
+    Everything the subclasses rely on is named with a leading
+    underscore, which no MATLAB field or method name can have, so the
+    strum's own names never shadow it.  The public strum_proxy and
+    strum_members give way to a field or method of the same name.
+
+    """
+    self._engine = engine
+    self._strum_proxy = strum_proxy
+    self._data = {}
+
+  def _get_data(self, field):
+    if field not in self._data:
+      tmp_name = self._engine.temp_name()
+      self._engine("%s = %s.%s;" % (tmp_name,
+        self._strum_proxy.matlab_name, field))
+      self._data[field] = self._engine.get_variable(tmp_name)
+    return self._data[field]
+
+  def _method_proxy(self, meth):
+    # cheap to build; the function proxy brings the strum back (and
+    # keeps its place in the engine's LRU order) together with the
+    # arguments of each call
+    return engine_function_proxy(self._engine,
+        "%s.%s" % (self._strum_proxy.workspace_name, meth),
+        docs="proxy for strum method %s -- no docs" % meth,
+        is_handle=True, proxy=self._strum_proxy)
+
+  def __get_strum_proxy(self): return self._strum_proxy
+  strum_proxy = property(__get_strum_proxy)
+
+  def __get_strum_members(self):
+    # everything, as the strum converter used to return it
+    tmp_name = self._engine.temp_name()
+    self._engine("%s = struct(%s);" % (tmp_name,
+      self._strum_proxy.matlab_name))
+    return self._engine.get_variable(tmp_name)
+  strum_members = property(__get_strum_members)
+
+class mx_array_pool(object):
+  def __init__(self, api, max_size=0):
+    """A bounded pool of mxArrays for reuse by same-shape pushes.
+
+    Arrays are keyed by (classID, is_complex, dims).  At most max_size
+    arrays are kept; past that the least recently returned ones are
+    destroyed.  max_size may be changed at any time, and 0 disables
+    pooling.  hits and misses count take() calls that did or didn't find
+    an array.
+
+    """
+    self.api = api
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    # (key, array pointer) pairs, least recently returned first.  the
+    # pool is small, so a list is plenty.
+    self.__arrays = []
+
+  def __len__(self):
+    return len(self.__arrays)
+
+  def take(self, key):
+    """Returns a pooled array matching key, or None."""
+    for i in xrange(len(self.__arrays) - 1, -1, -1):
+      if self.__arrays[i][0] == key:
+        self.hits += 1
+        return self.__arrays.pop(i)[1]
+    self.misses += 1
+    return None
+
+  def give(self, key, array_ptr):
+    """Hands array_ptr to the pool, which may destroy it right away."""
+    self.__arrays.append((key, array_ptr))
+    self.__trim(self.max_size)
+
+  def clear(self):
+    self.__trim(0)
+
+  def __trim(self, max_size):
+    while len(self.__arrays) > max_size:
+      self.api.mxDestroyArray(self.__arrays.pop(0)[1])
+
+class call_profile(object):
+  # the per-call phases we keep track of; "overhead" is the part of the
+  # eval that wasn't spent inside the MATLAB function itself
+  phases = ("push", "matlab", "overhead", "fetch")
+
+  def __init__(self):
+    """Aggregated timings of function proxy calls, by function name.
+
+    Each call is split into the time spent pushing arguments, the
+    MATLAB-side compute time (measured with tic/toc around the call), the
+    rest of the eval (engine round trip, parsing, output assignment) and
+    the time spent fetching and decoding the outputs.  All times are in
+    seconds.
+
+    """
+    self.__stats = {}
+
+  def record(self, name, push, matlab, overhead, fetch):
+    if name not in self.__stats:
+      self.__stats[name] = dict([ (p, 0.0) for p in self.phases ])
+      self.__stats[name]["calls"] = 0
+    stats = self.__stats[name]
+    stats["calls"] += 1
+    stats["push"] += push
+    stats["matlab"] += matlab
+    stats["overhead"] += overhead
+    stats["fetch"] += fetch
+
+  def names(self):
+    return self.__stats.keys()
+
+  def __contains__(self, name):
+    return name in self.__stats
+
+  def __getitem__(self, name):
+    """Totals for the function name, plus a "total" entry summing the
+    phases and a "calls" count."""
+    to_return = dict(self.__stats[name])
+    to_return["total"] = sum([ to_return[p] for p in self.phases ])
+    return to_return
+
+  def rows(self, sort_by="total"):
+    """A list of (name, stats) pairs, largest sort_by first."""
+    to_return = [ (name, self[name]) for name in self.__stats ]
+    to_return.sort(key=lambda row: row[1][sort_by], reverse=True)
+    return to_return
+
+  def report(self, sort_by="total"):
+    lines = [ "%-24s %8s %10s %10s %10s %10s %10s" % \
+        (("function", "calls") + self.phases + ("total",)) ]
+    for (name, stats) in self.rows(sort_by):
+      lines.append("%-24s %8d %10.4f %10.4f %10.4f %10.4f %10.4f" % \
+          ((name, stats["calls"]) + \
+            tuple([ stats[p] for p in self.phases ]) + (stats["total"],)))
+    return "\n".join(lines)
+
+  def __str__(self):
+    return self.report()
+
+  def clear(self):
+    self.__stats.clear()
+
+class engine_leftovers(object):
+  def __init__(self):
+    """Temporary files an engine leaves outside MATLAB: the spill
+    directory and the callback server's pipes.
+
+    The engine's converter tables hold its own bound methods, so under
+    Python 2 it sits in a reference cycle and its __del__ may never run.
+    An atexit hook holds on to this instead of the engine, so the files
+    go away at exit even when the engine is never collected.
+
+    """
+    self.directories = []
+    self.callback_servers = []
+
+  def release(self):
+    while len(self.callback_servers) > 0:
+      self.callback_servers.pop().close()
+    while len(self.directories) > 0:
+      shutil.rmtree(self.directories.pop(), ignore_errors=True)
+
 class engine(object):
-  def __init__(self, matlab_path):
+  def __init__(self, matlab_path, c_order_permute_threshold=None,
+      workspace_budget=None, spill_evicted=False, mx_pool_size=0):
     """MATLAB engine abstraction.
+
+    C-ordered arrays of at least c_order_permute_threshold bytes are
+    pushed as their (Fortran-ordered) transpose and permuted back inside
+    MATLAB, which beats a transposing copy in Python for large arrays.
+    The default of None always does the transposing copy in Python.
+
+    workspace_budget caps the number of bytes held in the MATLAB
+    workspace by proxied variables (see get_proxy).  When it's exceeded,
+    the least recently used proxies are cleared from the workspace; with
+    spill_evicted, they're saved to a temporary MAT-file first and loaded
+    back when the proxy is next used.  Both can be changed later through
+    the attributes of the same name.
+
+    Pushed numeric and logical arrays are built in mxArrays taken from
+    mx_pool, which keeps up to mx_pool_size of them around for later
+    pushes of the same class and shape.  The default of 0 doesn't pool.
+
+    Call close() when done with the engine; temporary files it made
+    are also removed at interpreter exit.
     
     """
+    self.__callback_server = None
+    self.__leftovers = engine_leftovers()
+    atexit.register(self.__leftovers.release)
+    self.mx_pool = None
+    self.__call_profile = None
+    self.__recorder = None
+    self.__resident = collections.OrderedDict()
+    self.__evicted = set()
+    self.__spill_directory = None
+    self.workspace_budget = workspace_budget
+    self.spill_evicted = spill_evicted
     self.api = matlab(matlab_path)
+    self.mx_pool = mx_array_pool(self.api, mx_pool_size)
+    self.c_order_permute_threshold = c_order_permute_threshold
     self.__function_proxies = {}
+    self.__strum_classes = {}
     self.__mat2py_converters = {}
     self.__py2mat_converters = {}
+    self.__py2mat_builtins = {}
+    self.__py2mat_cache = {}
 
     matlab_binary = os.path.sep.join([ matlab_path, "bin", "matlab" ])
     self.__engine_pointer = None
@@ -587,18 +1093,125 @@ class engine(object):
     self.register_mat2py_converter("strum", self.__mat2py_strum)
     self.register_mat2py_converter("fatrix", self.__mat2py_fatrix)
     self.register_mat2py_converter("fatrix2", self.__mat2py_fatrix)
+    self.register_mat2py_converter("table", self.__mat2py_table)
 
-    self.__start_callback_server()
+    self.__register_py2mat_builtins()
+
+    # pandas is optional; we only need it to push DataFrames
+    try:
+      import pandas
+      self.register_py2mat_converter(pandas.DataFrame,
+          self.__py2mat_dataframe)
+    except ImportError:
+      pass
 
   def __del__(self):
+    self.close()
+
+  def close(self):
+    """Shuts down MATLAB and removes the engine's temporary files.
+
+    Don't rely on garbage collection for this: the engine refers to
+    itself through its converters, so it may never be collected.
+
+    """
+    if self.__recorder is not None:
+      self.__recorder.close()
+      self.__recorder = None
+    self.__leftovers.release()
+    self.__callback_server = None
+    self.__spill_directory = None
+    if self.mx_pool is not None:
+      self.mx_pool.clear()
     if self.__engine_pointer is not None:
       self.api.engClose(self.__engine_pointer)
+      self.__engine_pointer = None
 
   def register_mat2py_converter(self, class_name, func):
     self.__mat2py_converters[class_name] = func
 
   def register_py2mat_converter(self, klass, func):
+    """Use func(name, value) to push instances of klass to MATLAB.
+
+    func is responsible for creating the MATLAB variable called name,
+    typically with set_variable/set_variables and eval.  Converters
+    apply to subclasses of klass too, and take precedence over the
+    built-in conversions.
+
+    """
     self.__py2mat_converters[klass] = func
+    self.__py2mat_cache.clear()
+
+  def __register_py2mat_builtins(self):
+    # the built-in conversions live in a table just like user-supplied
+    # converters; set_variable resolves a type against them once and
+    # caches the result
+    import types
+    import numpy as np
+    builtins = self.__py2mat_builtins
+    builtins[basestring] = self.__set_string_variable
+    builtins[dict] = self.__set_dict_variable
+    builtins[list] = self.__set_sequence_variable
+    builtins[tuple] = self.__set_sequence_variable
+    builtins[bool] = self.__set_scalar_variable
+    builtins[int] = self.__set_scalar_variable
+    builtins[long] = self.__set_scalar_variable
+    builtins[float] = self.__set_scalar_variable
+    builtins[complex] = self.__set_scalar_variable
+    builtins[np.generic] = self.__set_scalar_variable
+    builtins[np.ndarray] = self.__set_ndarray_variable
+    builtins[engine_object_proxy] = self.__set_proxy_variable
+    for klass in (types.FunctionType, types.BuiltinFunctionType,
+        types.MethodType):
+      builtins[klass] = self.__set_function_variable
+    try:
+      from scipy.sparse import spmatrix
+      builtins[spmatrix] = self.__set_sparse_variable
+    except ImportError:
+      pass
+    self.__py2mat_cache.clear()
+
+  def start_profiling(self):
+    """Starts timing function proxy calls; see call_profile.
+
+    Calls made while profiling is on run inside a tic/toc pair and cost
+    one extra scalar fetch each.  Returns the call_profile that collects
+    the timings, which is also available as the call_profile attribute
+    until stop_profiling is called.
+
+    """
+    if self.__call_profile is None:
+      self.__call_profile = call_profile()
+    return self.__call_profile
+
+  def stop_profiling(self):
+    """Stops timing function proxy calls and returns the call_profile."""
+    to_return = self.__call_profile
+    self.__call_profile = None
+    return to_return
+
+  def start_recording(self, path, payloads=False):
+    """Starts logging engine operations to a binary trace at path.
+
+    Every eval, set_variable and get_variable made from outside the
+    engine is logged with its timing and the shape and dtype of the
+    value; with payloads, array data is logged too.  set_variables and
+    get_variables are logged as single bulk operations, so the trace
+    keeps their one round trip.  See session_trace for reading and
+    replaying traces.
+
+    """
+    from session_trace import trace_recorder
+    self.stop_recording()
+    self.__recorder = trace_recorder(path, payloads)
+
+  def stop_recording(self):
+    if self.__recorder is not None:
+      self.__recorder.close()
+      self.__recorder = None
+
+  def __get_call_profile(self): return self.__call_profile
+  call_profile = property(__get_call_profile)
 
   def temp_name(self):
     to_return = "matropylis_tmp%d" % self.__tmp_num
@@ -620,17 +1233,26 @@ class engine(object):
       self.__function_proxies[name] = f
       return f
 
+  def map(self, name, arg_sets, uniform=True, nargout=1):
+    """Calls the MATLAB function name once per entry of arg_sets, in a
+    single round trip; see engine_function_proxy.map."""
+    return self.function_proxy(name).map(arg_sets, uniform=uniform,
+        nargout=nargout)
+
   def eval(self, text):
+    if self.__recorder is not None:
+      return self.__recorder.record_eval(text, self.__eval)
+    self.__eval(text)
+
+  def __eval(self, text):
     self.api.engEvalString(self.__engine_pointer, text)
 
   def __call__(self, text):
     return self.eval(text)
 
-  def __set_string_variable(self, name, value):
-    array_ptr = None
+  def __put_mx(self, name, array_ptr):
+    # hands a freshly built mxArray to MATLAB, then frees our copy
     try:
-      array_ptr = self.api.mxCreateCharMatrixFromStrings(1, 
-          ct.pointer(ct.c_char_p(value)))
       self.api.engPutVariable(self.__engine_pointer, name, array_ptr)
     except Exception, e:
       raise e
@@ -638,32 +1260,115 @@ class engine(object):
       if array_ptr is not None and array_ptr != 0:
         self.api.mxDestroyArray(array_ptr)
 
+  def __set_string_variable(self, name, value):
+    self.__put_mx(name, self.__string_mx(value))
+
+  def __string_mx(self, value):
+    # value may be a single string, a sequence of strings or an ndarray
+    # of strings; each string becomes one row of a space-padded char
+    # matrix, just like char({...}) would build it
+    import numpy as np
+    array_ptr = None
+    try:
+      codes = self.api.strings_to_char_codes(value)
+      (num_rows, num_cols) = codes.shape
+
+      dims = (ct.c_size_t * 2)(num_rows, num_cols)
+      array_ptr = self.api.mxCreateCharArray(2,
+          ct.cast(dims, ct.POINTER(ct.c_size_t)))
+      if codes.size > 0:
+        dst = self.api.as_ndarray(self.api.mxGetChars(array_ptr),
+            (num_rows, num_cols), np.uint16)
+        dst[...] = codes
+        dst[codes == 0] = ord(" ")
+
+      return array_ptr
+    except Exception, e:
+      if array_ptr is not None and array_ptr != 0:
+        self.api.mxDestroyArray(array_ptr)
+      raise e
+
   def __set_dict_variable(self, name, value):
     # we _could_ construct a struct object using the C api and move it
     # across all at once, but we would lose type checking.  instead, we
     # resort to the (possibly less satisfying) process of recursively
-    # pushing across variables
-
-    raise Exception("not implemented")
-    pass
+    # pushing across variables, all in one set_variables, and assigning
+    # them to fields in a single eval
+    field_names = []
+    field_values = {}
+    for (k, v) in value.items():
+      if not isinstance(k, basestring) or \
+          re.match(r"^[A-Za-z]\w*$", k) is None:
+        raise TypeError("%r isn't a valid MATLAB field name" % (k,))
+      tmp_name = self.temp_name()
+      field_names.append((str(k), tmp_name))
+      field_values[tmp_name] = v
+
+    if len(field_names) == 0:
+      self("%s = struct();" % name)
+      return
+    self.set_variables(field_values)
+    self("%s = struct(); %s clear %s;" % (name,
+        " ".join([ "%s.%s = %s;" % (name, k, tmp) \
+            for (k, tmp) in field_names ]),
+        " ".join(field_values.keys())))
 
   def __set_scalar_variable(self, name, value):
-    # this one's easy :-)
+    self.__set_ndarray_variable(name, self.api.scalar_array(value))
+
+  def __set_proxy_variable(self, name, value):
+    # the data is already in MATLAB; just give it another name
+    self("%s = %s;" % (name, value.matlab_name))
+
+  def __set_function_variable(self, name, value):
+    raise TypeError("passing function handles to MATLAB not supported")
+
+  def __set_sequence_variable(self, name, value):
+    # lists and tuples of numbers become arrays; lists of strings become
+    # char matrices
     import numpy as np
-    # argh, this is a touch annoying
-    if isinstance(value, bool) or isinstance(value, np.bool_):
-      # Python says True/False, MATLAB says true/false
-      if value:
-        self("%s = true" % name)
-      else:
-        self("%s = false" % name)
+    self.__set_ndarray_variable(name, np.asarray(value))
 
+  def __set_vector_variable(self, name, value):
+    # large C-ordered arrays can go across as their transpose, which is
+    # Fortran-ordered and needs no reordering, and get permuted back by
+    # MATLAB afterwards
+    threshold = self.c_order_permute_threshold
+    permute = threshold is not None and value.ndim >= 2 and \
+        value.flags.c_contiguous and not value.flags.f_contiguous and \
+        value.nbytes >= threshold
+    if permute:
+      value = value.T
+
+    # push data to MATLAB.  engPutVariable copies the array over to
+    # MATLAB, so a pooled array can be refilled and reused next time.
+    key = self.__vector_mx_key(value)
+    vec_ptr = self.mx_pool.take(key)
+    if vec_ptr is None:
+      vec_ptr = self.__vector_mx(value)
     else:
-      # rely on Python's object->string conversion
-      self("%s = %s" % (name, value))
+      try:
+        self.__fill_vector_mx(vec_ptr, value)
+      except Exception, e:
+        self.api.mxDestroyArray(vec_ptr)
+        raise e
+    try:
+      self.api.engPutVariable(self.__engine_pointer, name, vec_ptr)
+    finally:
+      self.mx_pool.give(key, vec_ptr)
 
-  def __set_vector_variable(self, name, value):
-    import numpy as np
+    if permute:
+      if value.ndim == 2:
+        self("%s = %s.';" % (name, name))
+      else:
+        self("%s = permute(%s, [%d:-1:1]);" % (name, name, value.ndim))
+
+  def __vector_mx_key(self, value):
+    # what an mxArray needs to match to be refilled with value
+    classID = self.api.dtype_to_classID(value.dtype)
+    return (classID, value.dtype.kind == "c", value.shape)
+
+  def __vector_mx(self, value):
     vec_ptr = None
     try:
       # dimension stuff
@@ -672,55 +1377,211 @@ class engine(object):
       for i in xrange(ndim): 
         dims[i] = value.shape[i]
 
-      # determine if vector is complex
-      is_complex = not np.allclose(value.imag, 0)
-      complexity_flag = \
-        self.api.mxCOMPLEX if is_complex else self.api.mxREAL
-
       # classID shizz
       classID = self.api.dtype_to_classID(value.dtype)
-      ctypeID = self.api.classID_to_dtype(classID)
+      ptr = ct.cast( dims, ct.POINTER(ct.c_size_t) )
 
       # MATLAB provides different APIs for creating numerical and
       # logical arrays.  we'll play their game.
       if classID == self.api.mxLOGICAL_CLASS:
-        raise TypeError("boolean arrays not quite supported yet")
-        ptr = ct.cast( dims, ct.POINTER(ct.c_size_t) )
         vec_ptr = self.api.mxCreateLogicalArray( ndim,
             ptr )
       else:
-        ptr = ct.cast( dims, ct.POINTER(ct.c_size_t) )
+        # complexity comes from the dtype; no need to scan the data
+        complexity_flag = self.api.mxCOMPLEX \
+            if value.dtype.kind == "c" else self.api.mxREAL
         vec_ptr = self.api.mxCreateNumericArray( ndim,
             ptr, classID, complexity_flag )
 
-      # copy data into place
-      real_dst_ptr = ct.cast(self.api.mxGetData(vec_ptr), 
-          ct.POINTER(ctypeID))
-      imag_dst_ptr = ct.cast(self.api.mxGetImagData(vec_ptr),
-          ct.POINTER(ctypeID))
-
-      # potentially very slow, but at least it works
-      # TODO figure out how to do this with memmove
-      for (i, r, c) in zip(xrange(value.size), 
-          value.real.flat, value.imag.flat):
-        real_dst_ptr[i] = r
-        if is_complex: imag_dst_ptr[i] = c
+      self.__fill_vector_mx(vec_ptr, value)
+      return vec_ptr
+    except Exception, e:
+      if vec_ptr is not None and vec_ptr != 0:
+        self.api.mxDestroyArray(vec_ptr)
+      raise e
 
-      # push data to MATLAB
-      self.api.engPutVariable(self.__engine_pointer, name, vec_ptr)
+  def __fill_vector_mx(self, vec_ptr, value):
+    # copies value into an mxArray of matching class, complexity and dims
+    import numpy as np
+    classID = self.api.dtype_to_classID(value.dtype)
+    ctypeID = self.api.classID_to_dtype(classID)
+
+    if classID == self.api.mxLOGICAL_CLASS:
+      # mxLogical is one byte per element, just like np.bool_, so the
+      # whole array goes across in a single bulk copy
+      dst = self.api.as_ndarray(self.api.mxGetLogicals(vec_ptr),
+          value.shape, np.bool_)
+      dst[...] = value
+      return
 
+    is_complex = value.dtype.kind == "c"
+    interleaved_addr = None
+    if is_complex:
+      interleaved_addr = self.api.interleaved_complex_data(vec_ptr,
+          classID)
+
+    if interleaved_addr is not None:
+      # numpy complex arrays are already interleaved, so this is a
+      # single copy with no real/imag split
+      self.api.as_ndarray(interleaved_addr, value.shape,
+          value.dtype)[...] = value
+    else:
+      real_dst = self.api.as_ndarray(self.api.mxGetData(vec_ptr),
+          value.shape, ctypeID)
+      real_dst[...] = value.real
+      if is_complex:
+        imag_dst = self.api.as_ndarray(
+            self.api.mxGetImagData(vec_ptr), value.shape, ctypeID)
+        imag_dst[...] = value.imag
+
+  def __set_sparse_variable(self, name, value):
+    self.__put_mx(name, self.__sparse_mx(value))
+
+  def __sparse_mx(self, value):
+    # MATLAB only does sparse double and sparse logical, so everything
+    # that isn't boolean gets promoted to double
+    import numpy as np
+    sp_ptr = None
+    try:
+      csc = value.tocsc()
+      csc.sum_duplicates()
+      (m, n) = csc.shape
+      nnz = csc.nnz
+      nzmax = max(nnz, 1)
+
+      is_complex = csc.dtype.kind == "c"
+      if csc.dtype == np.bool_:
+        sp_ptr = self.api.mxCreateSparseLogicalMatrix(m, n, nzmax)
+        data_addr = self.api.mxGetLogicals(sp_ptr)
+        data_dtype = np.bool_
+      else:
+        complexity_flag = \
+          self.api.mxCOMPLEX if is_complex else self.api.mxREAL
+        sp_ptr = self.api.mxCreateSparse(m, n, nzmax, complexity_flag)
+        data_addr = self.api.mxGetData(sp_ptr)
+        data_dtype = np.double
+
+      # scipy keeps CSC in exactly MATLAB's layout, so each of the three
+      # buffers is a single bulk copy
+      interleaved_addr = None
+      if is_complex:
+        interleaved_addr = self.api.interleaved_complex_data(sp_ptr,
+            self.api.mxDOUBLE_CLASS)
+      if interleaved_addr is not None:
+        self.api.as_ndarray(interleaved_addr, (nnz,),
+            np.complex128)[...] = csc.data
+      else:
+        self.api.as_ndarray(data_addr, (nnz,), data_dtype)[...] = \
+            csc.data.real
+        if is_complex:
+          self.api.as_ndarray(self.api.mxGetImagData(sp_ptr), (nnz,),
+              data_dtype)[...] = csc.data.imag
+      self.api.as_ndarray(self.api.mxGetIr(sp_ptr), (nnz,),
+          np.uintp)[...] = csc.indices
+      self.api.as_ndarray(self.api.mxGetJc(sp_ptr), (n+1,),
+          np.uintp)[...] = csc.indptr
+
+      return sp_ptr
     except Exception, e:
+      if sp_ptr is not None and sp_ptr != 0:
+        self.api.mxDestroyArray(sp_ptr)
       raise e
-    finally:
-      if vec_ptr is not None and vec_ptr != 0:
-        self.api.mxDestroyArray(vec_ptr)
+
+  def __set_struct_array_variable(self, name, value):
+    # numpy structured array -> MATLAB struct array.  each field goes
+    # across as one array (all of them in a single set_variables), and a
+    # single struct(...) call splits the columns back into records.
+    import numpy as np
+    if value.ndim == 0:
+      dims = (1, 1)
+    elif value.ndim == 1:
+      dims = (1, value.shape[0])
+    else:
+      dims = value.shape
+    records = value.reshape(-1, order="F")
+    num_records = records.size
+
+    columns = {}
+    struct_args = []
+    for field in value.dtype.names:
+      column = records[field]
+      tmp = self.temp_name()
+      if column.dtype.kind in "SU":
+        columns[tmp] = column.reshape(num_records)
+        struct_args.append("'%s', reshape(cellstr(%s), 1, [])" % \
+            (field, tmp))
+      elif column.dtype.kind in "biufc":
+        field_shape = column.shape[1:]
+        if len(field_shape) == 0:
+          columns[tmp] = column.reshape((1, num_records))
+          cell_dims = "1"
+        else:
+          # record index last, so num2cell can cut one record per cell
+          columns[tmp] = np.rollaxis(column, 0, column.ndim)
+          cell_dims = "1:%d" % len(field_shape)
+        struct_args.append("'%s', reshape(num2cell(%s, %s), 1, [])" % \
+            (field, tmp, cell_dims))
+      else:
+        raise TypeError("can't send field '%s' of dtype %s to MATLAB" % \
+            (field, column.dtype))
+
+    dims_str = " ".join([ str(d) for d in dims ])
+    if len(struct_args) == 0:
+      # no fields, so nothing to push (and nothing to clear)
+      self("%s = repmat(struct(), [%s]);" % (name, dims_str))
+      return
+
+    self.set_variables(columns)
+    self("%s = reshape(struct(%s), [%s]); clear %s;" % (name,
+        ", ".join(struct_args), dims_str, " ".join(columns.keys())))
 
   def __set_cell_variable(self, name, value):
-    raise Exception("writing cells not implemented... yet.")
-    pass
+    # plain elements are packed into the cell on our side.  the rest
+    # (dicts, proxies, ...) are set one by one and dropped into their
+    # slots by a single eval.
+    fallbacks = []
+    self.__put_mx(name, self.__cell_mx(value, fallbacks))
+    if len(fallbacks) > 0:
+      assignments = []
+      for (index, elem) in fallbacks:
+        tmp_name = self.temp_name()
+        self.set_variable(tmp_name, elem)
+        assignments.append("%s{%d} = %s; clear %s;" % (name, index+1,
+          tmp_name, tmp_name))
+      self(" ".join(assignments))
+
+  def __cell_mx(self, value, fallbacks=None):
+    # builds a cell mxArray from an object ndarray of at least two
+    # dimensions.  elements __py_to_mx can't handle are left empty and
+    # listed in fallbacks as (column-major index, element); without a
+    # fallbacks list, they make the whole thing return None.
+    cell_ptr = None
+    try:
+      ndim = len(value.shape)
+      dims = (ct.c_size_t * ndim)(*value.shape)
+      cell_ptr = self.api.mxCreateCellArray(ndim,
+          ct.cast(dims, ct.POINTER(ct.c_size_t)))
+      for (i, elem) in enumerate(value.flatten(order="F")):
+        elem_ptr = self.__py_to_mx(elem)
+        if elem_ptr is not None:
+          # the cell owns its elements from here on
+          self.api.mxSetCell(cell_ptr, i, elem_ptr)
+        elif fallbacks is not None:
+          fallbacks.append((i, elem))
+        else:
+          self.api.mxDestroyArray(cell_ptr)
+          return None
+      return cell_ptr
+    except Exception, e:
+      if cell_ptr is not None and cell_ptr != 0:
+        self.api.mxDestroyArray(cell_ptr)
+      raise e
 
   def __set_array_variable(self, name, value):
-    if value.dtype == object:
+    if value.dtype.kind in "SU":
+      # arrays (or lists) of strings become char matrices
+      self.__set_string_variable(name, value)
+    elif value.dtype == object:
       # potentially heterogeneous ndarray; looks like a job for a MATLAB
       # cell
       self.__set_cell_variable(name, value)
@@ -728,53 +1589,270 @@ class engine(object):
       self.__set_vector_variable(name, value)
 
   def set_variable(self, name, value):
+    if self.__recorder is not None:
+      return self.__recorder.record_set(name, value, self.__set_variable)
+    self.__set_variable(name, value)
+
+  def __set_variable(self, name, value):
     # there's a somewhat limited number of types of variables we can
-    # push to MATLAB, and it seems that we need to resort to heuristics
-    # in order to figure out how to dispatch an arbitrary type.
+    # push to MATLAB.  user converters and the built-in conversions are
+    # looked up along the value's MRO the first time we see its type;
+    # after that it's a single dict lookup.
+    self.__py2mat_handler(value.__class__)(name, value)
 
-    # string check (string -> string)
-    if isinstance(value, str):
-      self.__set_string_variable(name, value)
+  def __py2mat_handler(self, klass):
+    try:
+      return self.__py2mat_cache[klass]
+    except KeyError:
+      pass
+
+    import inspect
+    mro = inspect.getmro(klass)
+    handler = None
+    for table in (self.__py2mat_converters, self.__py2mat_builtins):
+      for k in mro:
+        if k in table:
+          handler = table[k]
+          break
+      if handler is not None:
+        break
+    if handler is None:
+      handler = self.__set_generic_variable
+
+    self.__py2mat_cache[klass] = handler
+    return handler
+
+  def __set_generic_variable(self, name, value):
+    # last resort: see if numpy can make an array out of it
+    import numpy as np
+    array = np.asarray(value)
+    if array.dtype == object and array.ndim == 0:
+      # we couldn't find a way to make the conversion to MATLAB... :-(
+      raise TypeError("couldn't convert '%s' to MATLAB" % value)
+    self.__set_ndarray_variable(name, array)
+
+  def __set_ndarray_variable(self, name, array):
+    # no copy here: whatever the memory layout, the data gets copied
+    # exactly once, straight into the mxArray's buffer
+    if array.dtype.names is not None:
+      # structured arrays (records -> struct array)
+      self.__set_struct_array_variable(name, array)
       return
+    elif len(array.shape) == 0:
+      # actually dealing with a scalar
+      array = array.reshape((1,1))
+    elif len(array.shape) == 1:
+      # automatically promote to Nx1 vector
+      array = array.reshape((array.shape[0],1))
 
-    # see if we're dealing with a dict (dict -> struct)
-    if isinstance(value, dict):
-      self.__set_dict_variable(name, value)
-      return
+    self.__set_array_variable(name, array)
+
+  def __is_sparse(self, value):
+    try:
+      from scipy.sparse import issparse
+    except ImportError:
+      return False
+    return issparse(value)
+
+  def __py_to_mx(self, value):
+    # builds an mxArray for plain data (strings, numeric/logical arrays
+    # and scalars, sparse matrices, cells of those) without talking to
+    # MATLAB.  values are dispatched just like in set_variable, so user
+    # converters win; anything whose handler isn't one of the built-ins
+    # below gets None and has to go through set_variable.
+    import numpy as np
+    handler = self.__py2mat_handler(value.__class__)
+    if handler == self.__set_string_variable:
+      return self.__string_mx(value)
+    elif handler == self.__set_sparse_variable:
+      return self.__sparse_mx(value)
+    elif handler == self.__set_scalar_variable:
+      return self.__ndarray_mx(self.api.scalar_array(value))
+    elif handler in (self.__set_sequence_variable,
+        self.__set_ndarray_variable, self.__set_generic_variable):
+      return self.__ndarray_mx(np.asarray(value))
+    return None
+
+  def __ndarray_mx(self, array):
+    # the mxArray __set_ndarray_variable would push, or None if it would
+    # need to talk to MATLAB (structured arrays, unconvertible objects)
+    if array.dtype.names is not None:
+      return None
+    if len(array.shape) == 0:
+      if array.dtype == object:
+        return None
+      array = array.reshape((1,1))
+    elif len(array.shape) == 1:
+      array = array.reshape((array.shape[0],1))
+    if array.dtype.kind in "SU":
+      return self.__string_mx(array)
+    if array.dtype == object:
+      return self.__cell_mx(array)
+    if array.dtype.kind not in "biufc":
+      return None
+    return self.__vector_mx(array)
+
+  def set_variables(self, variables):
+    """Set several workspace variables in one engine round trip.
+
+    variables maps names to values.  Plain data is packed into a single
+    cell array on the Python side, pushed once and unpacked by one eval;
+    proxies are assigned in that same eval.  Anything else (dicts,
+    objects with registered converters, ...) falls back to
+    set_variable.
 
-    # what if we're trying to pass a function?
-    # TODO come up with a nicer way to write this
-    if isinstance(value, self.set_variable.__class__):
-      raise TypeError("passing function handles to MATLAB not supported")
+    """
+    if self.__recorder is not None:
+      return self.__recorder.record_set_many(variables,
+          self.__set_variables)
+    return self.__set_variables(variables)
+
+  def __set_variables(self, variables):
+    packed_names = []
+    elem_ptrs = []
+    aliases = []
+    proxy_names = []
+    fallbacks = []
+    cell_ptr = None
+    try:
+      for (name, value) in variables.items():
+        if isinstance(value, engine_object_proxy):
+          # brought back all at once below, as in engine_function_proxy
+          aliases.append("%s = %s;" % (name, value.workspace_name))
+          proxy_names.append(value.workspace_name)
+          continue
+        if hasattr(value, "matlab_name"):
+          aliases.append("%s = %s;" % (name, value.matlab_name))
+          continue
+        elem_ptr = self.__py_to_mx(value)
+        if elem_ptr is None:
+          fallbacks.append((name, value))
+          continue
+        elem_ptrs.append(elem_ptr)
+        packed_names.append(name)
+
+      self.ensure_resident(*proxy_names)
+      eval_str = " ".join(aliases)
+      if len(packed_names) > 0:
+        cell_ptr = self.api.mxCreateCellMatrix(1, len(elem_ptrs))
+        for (i, elem_ptr) in enumerate(elem_ptrs):
+          self.api.mxSetCell(cell_ptr, i, elem_ptr)
+        # the cell owns its elements from here on
+        elem_ptrs = []
+
+        cell_name = self.temp_name()
+        self.api.engPutVariable(self.__engine_pointer, cell_name,
+            cell_ptr)
+        eval_str = "[%s] = %s{:}; clear %s; %s" % \
+            (", ".join(packed_names), cell_name, cell_name, eval_str)
+      if len(eval_str) > 0:
+        self(eval_str)
+    except Exception, e:
+      raise e
+    finally:
+      for elem_ptr in elem_ptrs:
+        self.api.mxDestroyArray(elem_ptr)
+      if cell_ptr is not None and cell_ptr != 0:
+        self.api.mxDestroyArray(cell_ptr)
+
+    for (name, value) in fallbacks:
+      self.set_variable(name, value)
+
+  def get_variables(self, names):
+    """Get several workspace variables in one engine round trip.
+
+    Returns a list of values in the same order as names.  The variables
+    are packed into a single cell array inside MATLAB and copied across
+    at once; variables that need a class-specific converter (structs,
+    cells, objects, function handles) are left out of that transfer and
+    fetched one by one.
+
+    """
+    names = list(names)
+    if len(names) == 0:
+      return []
+    if self.__recorder is not None:
+      return self.__recorder.record_get_many(names, self.__get_variables)
+    return self.__get_variables(names)
+
+  def __get_variables(self, names):
+    cell_name = self.temp_name()
+    self("%s = {%s};" % (cell_name, ", ".join(names)))
+    try:
+      return self.__get_cell_elements(cell_name)
+    finally:
+      self("clear %s;" % cell_name)
+
+  def __get_cell_elements(self, cell_name):
+    # fetches a whole cell array in one transfer and returns its elements
+    # as a list, in column-major order.  only elements of plain classes
+    # make the trip: the rest (structs, cells, objects, function handles)
+    # are blanked out of the transferred copy by the same eval and
+    # fetched one by one afterwards.
+    plain_classes = "{'logical', 'char', 'double', 'single', 'int8', " \
+        "'uint8', 'int16', 'uint16', 'int32', 'uint32', 'int64', " \
+        "'uint64'}"
+    pack_name = self.temp_name()
+    self(("%(p)s = {%(c)s, cellfun(@(x) ismember(class(x), %(plain)s), " \
+        "%(c)s)}; %(p)s{1}(~%(p)s{2}) = {[]};") % \
+        { "p" : pack_name, "c" : cell_name, "plain" : plain_classes })
 
-    # attempt to make an array out of it
     import numpy as np
+    pack_ptr = None
     try:
-      array = np.array(value, order='F')
-      if len(array.shape) == 0:
-        # actually dealing with a scalar
-        self.__set_scalar_variable(name, array.flat[0])
-        return
-      elif len(array.shape) == 1:
-        # automatically promote to Nx1 vector
-        array.shape = (array.shape[0],1)
-
-      self.__set_array_variable(name, array)
-      return
+      pack_ptr = self.api.engGetVariable(self.__engine_pointer, pack_name)
+      cell_ptr = self.api.mxGetCell(pack_ptr, 0)
+      is_plain = np.ravel(self.__mx_to_py(self.api.mxGetCell(pack_ptr, 1)))
+      to_return = [ None ] * self.api.mxGetNumberOfElements(cell_ptr)
+      for i in xrange(len(to_return)):
+        elem_ptr = self.api.mxGetCell(cell_ptr, i)
+        if is_plain[i] and elem_ptr is not None and elem_ptr != 0:
+          to_return[i] = self.__mx_to_py(elem_ptr)
+        elif is_plain[i]:
+          # MATLAB may hand back unset (empty) elements as NULL
+          to_return[i] = np.empty((0, 0))
+        else:
+          elem_tmp_name = self.temp_name()
+          self("%s = %s{%d};" % (elem_tmp_name, cell_name, i+1))
+          to_return[i] = self.get_variable(elem_tmp_name)
+      return to_return
     except Exception, e:
-      print "conversion error: ", e.__class__, e
+      raise e
+    finally:
+      if pack_ptr is not None and pack_ptr != 0:
+        self.api.mxDestroyArray(pack_ptr)
+      self("clear %s;" % pack_name)
 
-    # see if some brave soul has added a converter for us
-    if value.__class__ in self.__py2mat_converters.keys():
-      # TODO figure out the right way to do this esp. the function
-      # signature
-      raise Exception("user-defined py2mat converters not done yet")
-      self.__py2mat_converters[value.__class__](name, value)
+  def get_variable(self, name, proxy=False, out=None, zero_copy=False):
+    """Copy a variable from the MATLAB workspace into Python.
 
-    # we couldn't find a way to make the conversion to MATLAB... :-(
-    raise TypeError("couldn't convert '%s' to MATLAB" % value)
+    For dense numeric and logical variables, out may be a preallocated
+    ndarray of matching shape and dtype; the variable is decoded
+    directly into it and out is returned.  A complex out also takes a
+    real variable of the same precision, since MATLAB drops all-zero
+    imaginary parts.
 
-  def get_variable(self, name, proxy=False):
+    With zero_copy, a sparse matrix shares its data and index arrays
+    with the fetched mxArray instead of copying them; the mxArray is
+    freed once the arrays are garbage collected.  Its indices are then
+    64-bit rather than the narrower copies made otherwise.
+
+    """
+    if self.__recorder is not None:
+      return self.__recorder.record_get(name, self.__get_variable, proxy,
+          out, zero_copy)
+    return self.__get_variable(name, proxy, out, zero_copy)
+
+  def get_plain_variable(self, name, out=None):
+    """Like get_variable, for a variable known to be numeric, logical or
+    char.  This skips get_variable's whos lookup, so it costs a single
+    engGetVariable."""
+    if self.__recorder is not None:
+      return self.__recorder.record_get(name, self.__get_variable_normal,
+          None, out)
+    return self.__get_variable_normal(name, None, out)
+
+  def __get_variable(self, name, proxy=False, out=None, zero_copy=False):
     # shortcut/consistency
     if proxy: return self.get_proxy(name)
 
@@ -809,7 +1887,8 @@ class engine(object):
       self.api.mxGetString(class_name_ptr, name_buf, num_chars+1)
       class_name = name_buf.value
 
-      return self.__get_variable_with_class_name(name, class_name)
+      return self.__get_variable_with_class_name(name, class_name, out,
+          zero_copy)
     except Exception, e:
       #import traceback
       #traceback.print_exc()
@@ -819,54 +1898,134 @@ class engine(object):
         self.api.mxDestroyArray(whos_ptr)
 
   def __mat2py_strum(self, var_name, class_name):
-    class strum(object):
-      def __init__(self, strum_proxy, strum_members):
-        self.strum_members = strum_members
-
-        # setup stuff in meth
-        for (k, v) in self.strum_members["meth"].items():
-          def make_wrapper(val):
-            def strum_func_wrapper(*args, **kwargs):
-              if "nargout" not in kwargs.keys():
-                return val(strum_proxy, *args, nargout=1, **kwargs)
-              else:
-                return val(strum_proxy, *args, **kwargs)
-            return strum_func_wrapper
-          setattr(self, k, make_wrapper(v))
-
-        for (k, v) in self.strum_members["data"].items():
-          setattr(self, k, v)
-
     assert(class_name == "strum")
-    tmp_name = self.temp_name()
-    self("%s = struct(%s);" % (tmp_name, var_name))
-    strum_members = self.get_variable(tmp_name)
-    strum_proxy = self.get_variable(var_name, proxy=True)
-    to_return = strum(strum_proxy, strum_members)
-
+    # the strum stays in MATLAB under a name of its own; we only need the
+    # names of its methods and data fields up front
+    strum_tmp = self.temp_name()
+    members_tmp = self.temp_name()
+    meth_tmp = self.temp_name()
+    data_tmp = self.temp_name()
+    self(("%(strum)s = %(var)s; %(members)s = struct(%(strum)s); " \
+        "%(meth)s = char(fieldnames(%(members)s.meth)); " \
+        "%(data)s = char(fieldnames(%(members)s.data)); " \
+        "clear %(members)s;") % { "strum" : strum_tmp, "var" : var_name,
+          "members" : members_tmp, "meth" : meth_tmp, "data" : data_tmp })
+    names = []
+    for field_names in self.get_variables([meth_tmp, data_tmp]):
+      if isinstance(field_names, basestring):
+        field_names = [ field_names ]
+      names.append(tuple([ str(f) for f in field_names if len(f) > 0 ]))
+
+    return self.__strum_class(*names)(self, self.get_proxy(strum_tmp))
+
+  def __strum_class(self, meth_names, data_names):
+    # wrappers are built once for each distinct set of methods and data
+    # fields, as properties and methods of a strum subclass
+    key = (meth_names, data_names)
+    if key in self.__strum_classes:
+      return self.__strum_classes[key]
+
+    def make_method(meth):
+      def strum_method(self, *args, **kwargs):
+        if "nargout" not in kwargs.keys():
+          kwargs["nargout"] = 1
+        return self._method_proxy(meth)(*args, **kwargs)
+      strum_method.__name__ = meth
+      return strum_method
+
+    def make_data(field):
+      return property(lambda self: self._get_data(field))
+
+    namespace = {}
+    for meth in meth_names:
+      namespace[meth] = make_method(meth)
+    for field in data_names:
+      namespace[field] = make_data(field)
+    to_return = type("strum", (strum,), namespace)
+    self.__strum_classes[key] = to_return
     return to_return
 
   def __mat2py_fatrix(self, var_name, class_name):
+    import numpy as np
+
+    def fingerprint(value):
+      # a cheap content check for the resident input vector; None means
+      # the value can't be checked, so it's always pushed
+      if isinstance(value, np.ndarray) and value.dtype.kind in "biufc" \
+          and (value.flags.c_contiguous or value.flags.f_contiguous):
+        return (value.shape, value.dtype.str, zlib.crc32(value.data))
+      return None
+
     class fatrix(object):
-      def __init__(self, engine, fatrix_members, is_transpose):
-        self.fatrix_members = fatrix_members
-        self.is_transpose = is_transpose
+      def __init__(self, engine, state, is_transpose):
+        # state is shared with the transpose: the struct(A) members once
+        # fetched, and the workspace variables used for inputs/outputs
         self.engine = engine
         self.var_name = var_name
+        self.is_transpose = is_transpose
+        self.__state = state
+
+      def __get_fatrix_members(self):
+        if self.__state["members"] is None:
+          tmp_name = self.engine.temp_name()
+          self.engine("%s = struct(%s);" % (tmp_name, self.var_name))
+          self.__state["members"] = self.engine.get_variable(tmp_name)
+        return self.__state["members"]
+      fatrix_members = property(__get_fatrix_members)
+
+      def __push_input(self, other):
+        # the last input stays in the workspace, so A*x followed by A'*x
+        # (or vice versa) only pushes x once
+        if hasattr(other, "matlab_name"):
+          return other.matlab_name
+        state = self.__state
+        other_fingerprint = fingerprint(other)
+        if other_fingerprint is None or state["input"] is not other or \
+            state["input_fingerprint"] != other_fingerprint:
+          self.engine.set_variable(state["input_name"], other)
+          state["input"] = other if other_fingerprint is not None else None
+          state["input_fingerprint"] = other_fingerprint
+        return state["input_name"]
+
+      def __operator(self, transpose):
+        if transpose:
+          return "%s'" % self.var_name
+        return self.var_name
+
+      def __apply(self, transpose, other):
+        in_name = self.__push_input(other)
+        out_name = self.__state["output_name"]
+        self.engine("%s = %s*%s;" % (out_name, self.__operator(transpose),
+          in_name))
+        return self.engine.get_variable(out_name)
+
+      def __apply_many(self, transpose, X):
+        # one push, one eval and one fetch for the whole stack
+        names = { "in" : self.__push_input(X),
+            "out" : self.__state["output_name"],
+            "k" : self.__state["index_name"],
+            "A" : self.__operator(transpose) }
+        self.engine(("%(out)s = cell(1, size(%(in)s, 2)); " \
+            "for %(k)s = 1:size(%(in)s, 2), " \
+            "%(out)s{%(k)s} = reshape(%(A)s*%(in)s(:, %(k)s), [], 1); " \
+            "end; %(out)s = [%(out)s{:}];") % names)
+        return self.engine.get_variable(names["out"])
 
       def forward(self, other):
-        tmp_name_in = self.engine.temp_name()
-        tmp_name_out = self.engine.temp_name()
-        self.engine.set_variable(tmp_name_in, other)
-        self.engine("%s = %s*%s;" % (tmp_name_out, self.var_name, tmp_name_in))
-        return self.engine.get_variable(tmp_name_out)
+        return self.__apply(False, other)
 
       def back(self, other):
-        tmp_name_in = self.engine.temp_name()
-        tmp_name_out = self.engine.temp_name()
-        self.engine.set_variable(tmp_name_in, other)
-        self.engine("%s = %s'*%s;" % (tmp_name_out, self.var_name, tmp_name_in))
-        return self.engine.get_variable(tmp_name_out)
+        return self.__apply(True, other)
+
+      def forward_many(self, X):
+        """Applies the operator to each column of X, returning the
+        results as the columns of a matrix."""
+        return self.__apply_many(False, X)
+
+      def back_many(self, X):
+        """Applies the adjoint to each column of X, returning the
+        results as the columns of a matrix."""
+        return self.__apply_many(True, X)
 
       def __call__(self, other):
         if not self.is_transpose:
@@ -878,20 +2037,21 @@ class engine(object):
         return self(other)
         
       def transpose(self):
-        return fatrix(self.engine, self.fatrix_members, not self.is_transpose)
+        return fatrix(self.engine, self.__state, not self.is_transpose)
 
       T = property(transpose)
       t = property(transpose)
 
     assert(class_name == "fatrix" or class_name == "fatrix2")
-    tmp_name = self.temp_name()
-    self("%s = struct(%s);" % (tmp_name, var_name))
-    fatrix_members = self.get_variable(tmp_name)
-    to_return = fatrix(self, fatrix_members, is_transpose=False)
+    state = { "members" : None, "input" : None, "input_fingerprint" : None,
+        "input_name" : self.temp_name(), "output_name" : self.temp_name(),
+        "index_name" : self.temp_name() }
+    to_return = fatrix(self, state, is_transpose=False)
 
     return to_return
 
-  def __get_variable_with_class_name(self, var_name, class_name):
+  def __get_variable_with_class_name(self, var_name, class_name,
+      out=None, zero_copy=False):
     # check for special handlers
     class_name = class_name.lower()
 
@@ -900,9 +2060,13 @@ class engine(object):
       class_name = "function_handle"
 
     if class_name in self.__mat2py_converters:
+      if out is not None:
+        raise TypeError("can't decode MATLAB %s into an out array" % \
+            class_name)
       return self.__mat2py_converters[class_name](var_name, class_name)
     else:
-      return self.__get_variable_normal(var_name, class_name)
+      return self.__get_variable_normal(var_name, class_name, out,
+          zero_copy)
 
   def __mat2py_func(self, var_name, class_name):
     proxy = engine_function_proxy(self, var_name, 
@@ -912,175 +2076,446 @@ class engine(object):
 
   def __mat2py_cell(self, var_name, class_name):
     assert(class_name == "cell")
-    # we need to get the size of the cell without attempting to copy
-    # over the cell itself
-    size_tmp_name = self.temp_name()
-    self("%s = size(%s)" % (size_tmp_name, var_name))
-    size = self.get_variable(size_tmp_name)
-
     import numpy as np
-    to_return = np.empty(dtype=object, shape=size)
-    for i in xrange(to_return.size):
-      elem_tmp_name = self.temp_name()
-      coords_base0 = self.api.index_to_coords(size, i)
-      coords_base1_str = None
-      if hasattr(coords_base0, "__len__"):
-        coords_base1 = [ x+1 for x in coords_base0 ]
-        coords_base1_str = ", ".join(coords_base1)
-      else:
-        coords_base1_str = "%s" % (coords_base0 + 1)
-
-      self("%s = %s{%s}" % (elem_tmp_name, var_name, coords_base1_str))
-      to_return.flat[i] = self.get_variable(elem_tmp_name)
+    size_tmp_name = self.temp_name()
+    self("%s = size(%s);" % (size_tmp_name, var_name))
+    size = [ int(d) for d in np.ravel(self.get_variable(size_tmp_name)) ]
 
-    return to_return.T
+    # the whole cell comes across at once; see __get_cell_elements
+    elems = self.__get_cell_elements(var_name)
+    to_return = np.empty(dtype=object, shape=(len(elems),))
+    for (i, elem) in enumerate(elems):
+      to_return[i] = elem
+    return to_return.reshape(size, order="F")
 
   def __mat2py_struct(self, var_name, class_name):
     assert(class_name == "struct")
+    import numpy as np
     # in order to avoid attempting to copy over e.g., function handles,
-    # we need to specifically get the names of the members of the struct
+    # we need to specifically get the names of the members of the struct.
+    # char() turns them into a matrix we can pull across in one go.
+    size_tmp = self.temp_name()
     field_names_tmp = self.temp_name()
-    self("%s = fieldnames(%s)" % (field_names_tmp, var_name))
-
-    # we know this is a cell of strings, so we can safely directly copy
-    # it over
-    field_names_ptr = None
-    try:
-      # get the field names ptr and the number of names
-      field_names_ptr = self.api.engGetVariable(self.__engine_pointer,
-          field_names_tmp)
-      num_names = self.api.mxGetDimensions(field_names_ptr)[0]
-
-      # pull across each by building a dictionary
-      to_return = {}
-      for name_id in xrange(num_names):
-        field_tmp_name = self.temp_name()
-        self("%s = %s{%d}" % (field_tmp_name, field_names_tmp, name_id+1))
-        field_name = self.get_variable(field_tmp_name)
-
-        field_data_tmp_name = self.temp_name()
-        self("%s = %s.%s" % (field_data_tmp_name, var_name, field_name))
-        to_return[field_name] = self.get_variable(field_data_tmp_name)
-
-      return to_return
-    except Exception, e:
-      raise e
-    finally:
-      if field_names_ptr is not None and field_names_ptr != 0:
-        self.api.mxDestroyArray(field_names_ptr)
-
-    raise TypeError("not quite supported yet")
-
-  def __get_variable_normal(self, var_name, class_name):
+    self("%s = size(%s); %s = char(fieldnames(%s));" % \
+        (size_tmp, var_name, field_names_tmp, var_name))
+    (size, field_names) = self.get_variables([size_tmp, field_names_tmp])
+
+    size = [ int(d) for d in np.ravel(size) ]
+    if isinstance(field_names, basestring):
+      field_names = [ field_names ]
+    field_names = [ str(f) for f in field_names if len(f) > 0 ]
+
+    if reduce(lambda x,y:x*y, size, 1) != 1:
+      return self.__mat2py_struct_array(var_name, size, field_names)
+
+    # a single struct becomes a dictionary
+    field_tmps = [ self.temp_name() for f in field_names ]
+    if len(field_tmps) > 0:
+      self(" ".join([ "%s = %s.%s;" % (tmp, var_name, f) \
+          for (tmp, f) in zip(field_tmps, field_names) ]))
+    return dict(zip(field_names, self.get_variables(field_tmps)))
+
+  def __mat2py_struct_array(self, var_name, size, field_names):
+    # struct arrays whose fields are numeric/logical of one class and one
+    # size, or strings, come across column by column: each field is
+    # concatenated inside MATLAB and moved as a single array, then the
+    # columns are stitched into a numpy structured array.  anything
+    # less regular falls back to an object array of dicts.
+    import numpy as np
+    num_records = reduce(lambda x,y:x*y, size, 1)
+    if len([ d for d in size if d != 1 ]) <= 1:
+      shape = (num_records,)
+    else:
+      shape = tuple(size)
+
+    column_tmps = [ self.temp_name() for f in field_names ]
+    kinds_tmp = self.temp_name()
+    stmts = [ "%s = zeros(1, %d);" % (kinds_tmp, len(field_names)) ]
+    for (k, (field, column)) in enumerate(zip(field_names, column_tmps)):
+      args = { "s" : var_name, "f" : field, "c" : column,
+          "kinds" : kinds_tmp, "k" : k+1, "n" : num_records }
+      stmts.append(("%(c)s = []; " \
+          "try, %(c)s = cat(ndims(%(s)s(1).%(f)s)+1, %(s)s.%(f)s); " \
+          "if (isnumeric(%(c)s) || islogical(%(c)s)) && " \
+          "numel(%(c)s) == %(n)d*numel(%(s)s(1).%(f)s) && " \
+          "all(cellfun('isclass', {%(s)s.%(f)s}, class(%(c)s))), " \
+          "%(kinds)s(%(k)d) = 1; end; catch, end; " \
+          "if ~%(kinds)s(%(k)d) && " \
+          "all(cellfun('isclass', {%(s)s.%(f)s}, 'char')), " \
+          "%(c)s = char({%(s)s.%(f)s}); %(kinds)s(%(k)d) = 2; end;") % args)
+    if num_records > 0:
+      self(" ".join(stmts))
+      kinds = np.ravel(self.get_variable(kinds_tmp))
+    else:
+      kinds = np.zeros(len(field_names))
+
+    if num_records == 0 or not np.all(kinds > 0):
+      to_return = np.empty(dtype=object, shape=(num_records,))
+      for i in xrange(num_records):
+        elem_tmp_name = self.temp_name()
+        self("%s = %s(%d);" % (elem_tmp_name, var_name, i+1))
+        to_return[i] = self.get_variable(elem_tmp_name)
+      return to_return.reshape(shape, order="F")
+
+    columns = self.get_variables(column_tmps)
+    self("clear %s %s;" % (kinds_tmp, " ".join(column_tmps)))
+
+    descr = []
+    records = []
+    for (field, kind, column) in zip(field_names, kinds, columns):
+      if kind == 1:
+        # MATLAB puts the record index last; numpy wants it first
+        column = np.asarray(column)
+        field_shape = tuple([ d for d in column.shape[:-1] if d != 1 ])
+        column = np.rollaxis(column, column.ndim-1, 0)
+        column = column.reshape((num_records,) + field_shape)
+      else:
+        column = np.asarray(column).reshape(num_records)
+        field_shape = ()
+      descr.append((field, column.dtype, field_shape))
+      records.append(column)
+
+    to_return = np.empty(dtype=descr, shape=(num_records,))
+    for (field, column) in zip(field_names, records):
+      to_return[field] = column
+    return to_return.reshape(shape, order="F")
+
+  def __mat2py_table(self, var_name, class_name):
+    # MATLAB table -> pandas DataFrame.  every table variable comes
+    # across as one bulk array: numeric/logical as-is, strings as a char
+    # matrix, categoricals as their codes plus a char matrix of
+    # categories.
+    assert(class_name == "table")
+    import numpy as np
+    import pandas as pd
+
+    def as_strings(x, count=None):
+      # a char matrix comes back as a single string when it has one row,
+      # and as "" when it has no columns, so "" could be no strings or
+      # any number of empty ones.  count says which, when we know it;
+      # otherwise "" means none (e.g., categories can't be empty).
+      if isinstance(x, basestring):
+        if count is None:
+          return [ x ] if len(x) > 0 else []
+        return [ x ] * count
+      return list(x)
+
+    size_tmp = self.temp_name()
+    names_tmp = self.temp_name()
+    rows_tmp = self.temp_name()
+    self("%s = [width(%s), height(%s), " \
+        "numel(%s.Properties.RowNames)]; " \
+        "%s = char(%s.Properties.VariableNames); " \
+        "%s = char(%s.Properties.RowNames);" % (size_tmp, var_name,
+          var_name, var_name, names_tmp, var_name, rows_tmp, var_name))
+    (size, names, row_names) = self.get_variables([size_tmp, names_tmp,
+      rows_tmp])
+    (width, height, num_row_names) = [ int(d) for d in np.ravel(size) ]
+    names = as_strings(names, width)
+    row_names = as_strings(row_names, num_row_names)
+
+    column_tmps = [ self.temp_name() for k in xrange(width) ]
+    category_tmps = [ self.temp_name() for k in xrange(width) ]
+    kinds_tmp = self.temp_name()
+    stmts = [ "%s = zeros(1, %d);" % (kinds_tmp, width) ]
+    for k in xrange(width):
+      args = { "t" : var_name, "k" : k+1, "c" : column_tmps[k],
+          "g" : category_tmps[k], "kinds" : kinds_tmp }
+      stmts.append(("%(c)s = %(t)s.(%(k)d); %(g)s = ''; " \
+          "if iscategorical(%(c)s), %(g)s = char(categories(%(c)s)); " \
+          "%(c)s = double(%(c)s); %(kinds)s(%(k)d) = 3; " \
+          "elseif iscellstr(%(c)s) || isa(%(c)s, 'string'), " \
+          "%(c)s = char(%(c)s); %(kinds)s(%(k)d) = 2; " \
+          "elseif isnumeric(%(c)s) || islogical(%(c)s), " \
+          "%(kinds)s(%(k)d) = 1; " \
+          "else, %(c)s = []; end;") % args)
+    self(" ".join(stmts))
+
+    values = self.get_variables([ kinds_tmp ] + column_tmps + category_tmps)
+    kinds = np.ravel(values[0])
+    columns = values[1:width+1]
+    categories = values[width+1:]
+    self("clear %s %s %s %s %s %s;" % (kinds_tmp, " ".join(column_tmps),
+        " ".join(category_tmps), size_tmp, names_tmp, rows_tmp))
+
+    data = {}
+    order = []
+    for (name, kind, column, cats) in zip(names, kinds, columns,
+        categories):
+      if kind == 0:
+        raise TypeError("can't convert table variable '%s' to Python" % \
+            name)
+      elif kind == 1:
+        column = np.atleast_2d(column)
+        column = column.reshape((column.shape[0], -1), order="F")
+        if column.shape[1] == 1:
+          data[name] = column[:, 0]
+          order.append(name)
+        else:
+          # multi-column table variables get split up
+          for j in xrange(column.shape[1]):
+            split_name = "%s_%d" % (name, j+1)
+            data[split_name] = column[:, j]
+            order.append(split_name)
+      elif kind == 2:
+        data[name] = np.array(as_strings(column, height),
+            dtype=np.unicode_)
+        order.append(name)
+      else:
+        codes = np.ravel(column)
+        codes = np.where(np.isnan(codes), 0, codes).astype(np.intp) - 1
+        data[name] = pd.Categorical.from_codes(codes, as_strings(cats))
+        order.append(name)
+
+    index = None
+    if len(row_names) > 0:
+      index = row_names
+    return pd.DataFrame(data, columns=order, index=index)
+
+  def __py2mat_dataframe(self, name, frame):
+    # pandas DataFrame -> MATLAB table.  each column is pushed as one
+    # array (all of them in a single set_variables) and the table is
+    # assembled with a single table(...) call.
+    import numpy as np
+    import pandas as pd
+    columns = {}
+    table_args = []
+    for col_name in frame.columns:
+      series = frame[col_name]
+      tmp = self.temp_name()
+      if series.dtype.name == "category":
+        cats_tmp = self.temp_name()
+        categories = [ unicode(c) for c in series.cat.categories ]
+        columns[tmp] = np.asarray(series.cat.codes, dtype=np.double)
+        columns[cats_tmp] = np.array(categories, dtype=np.unicode_)
+        # codes of -1 aren't in the value set, so they become <undefined>
+        table_args.append("categorical(%s, 0:%d, cellstr(%s))" % \
+            (tmp, len(categories)-1, cats_tmp))
+      elif series.dtype.kind in "biufc":
+        columns[tmp] = np.asarray(series)
+        table_args.append(tmp)
+      elif series.dtype.kind in "OSU":
+        columns[tmp] = np.asarray(series).astype(np.unicode_)
+        table_args.append("cellstr(%s)" % tmp)
+      else:
+        raise TypeError("can't send column '%s' of dtype %s to MATLAB" % \
+            (col_name, series.dtype))
+
+    if len(table_args) > 0:
+      var_names = ", ".join([ "'%s'" % str(c).replace("'", "''") \
+          for c in frame.columns ])
+      table_args.append("'VariableNames', {%s}" % var_names)
+
+    # anything but the default 0..n-1 index goes across as RowNames,
+    # which come back as the index on the way out
+    index = frame.index
+    if len(index) > 0 and not (isinstance(index, pd.RangeIndex) and \
+        index.equals(pd.RangeIndex(len(index)))):
+      rows_tmp = self.temp_name()
+      columns[rows_tmp] = np.array([ unicode(r) for r in index ],
+          dtype=np.unicode_)
+      table_args.append("'RowNames', cellstr(%s)" % rows_tmp)
+
+    self.set_variables(columns)
+    eval_str = "%s = table(%s);" % (name, ", ".join(table_args))
+    if len(columns) > 0:
+      eval_str += " clear %s;" % " ".join(columns.keys())
+    self(eval_str)
+
+  def __get_variable_normal(self, var_name, class_name, out=None,
+      zero_copy=False):
     # handler for loading dense and sparse arrays of fundamental types
     ptr = None
     try:
       ptr = self.api.engGetVariable(self.__engine_pointer, var_name)
+      if zero_copy:
+        # the owner frees the mxArray from now on
+        owner = mx_array_owner(self.api, ptr)
+        ptr = None
+        return self.__mx_to_py(owner.array_ptr, out, owner)
+      return self.__mx_to_py(ptr, out)
+    except Exception, e:
+      raise e
+    finally:
+      if ptr is not None and ptr != 0:
+        self.api.mxDestroyArray(ptr)
 
-      # get a bit of helpful info:
-      # - sparsity:
-      is_sparse = self.api.mxIsSparse(ptr)
-
-      # - dimensions:
-      num_dimensions = self.api.mxGetNumberOfDimensions(ptr)
-      dims_buf = self.api.mxGetDimensions(ptr)
-      dims = [ dims_buf[i] for i in xrange(num_dimensions) ]
-
-      # - classID, numpy datatype
-      classID = self.api.mxGetClassID(ptr)
-      is_string = classID == self.api.mxCHAR_CLASS
-      numpy_dtype = self.api.classID_to_dtype(classID)
-
-      # - real/complex?
-      is_complex = self.api.mxIsComplex(ptr)
-
-      if is_string:
-        # dense (MATLAB's limitation) string
-        import numpy as np
-
-        num_chars = self.api.mxGetNumberOfElements(ptr)
-        char_buf = (ct.c_char * (num_chars+1))()
-
-        self.api.mxGetString(ptr, char_buf, num_chars+1)
-
-        dims[1] = 1
-        dims = tuple(dims)
-        tmp = np.ctypeslib.as_array(ct.pointer(char_buf),
-            shape=dims).copy()
+  def __mx_to_sparse(self, ptr, dims, classID, is_complex, owner):
+    from scipy.sparse import csc_matrix
+    import numpy as np
+    dims = tuple(dims)
+    numpy_dtype = np.dtype(self.api.classID_to_dtype(classID))
+    if is_complex:
+      numpy_dtype = np.result_type(numpy_dtype, np.complex64)
+
+    # MATLAB sparse matrices are CSC with size_t indices.  Jc[n] is the
+    # number of entries actually stored; nzmax is only the capacity.
+    col = self.api.as_ndarray(self.api.mxGetJc(ptr), (dims[1]+1,),
+        np.uintp, owner)
+    num_entries = int(col[-1])
+    row_ind = self.api.as_ndarray(self.api.mxGetIr(ptr), (num_entries,),
+        np.uintp, owner)
+
+    if owner is not None:
+      # scipy wants signed indices, which are the same width as size_t
+      col = col.view(np.intp)
+      row_ind = row_ind.view(np.intp)
+    else:
+      if max(num_entries, dims[0]) <= np.iinfo(np.int32).max:
+        index_dtype = np.int32
+      else:
+        index_dtype = np.intp
+      col = col.astype(index_dtype)
+      row_ind = row_ind.astype(index_dtype)
+
+    interleaved_addr = None
+    if is_complex:
+      interleaved_addr = self.api.interleaved_complex_data(ptr, classID)
+
+    if interleaved_addr is not None:
+      data = self.api.as_ndarray(interleaved_addr, (num_entries,),
+          numpy_dtype, owner)
+      if owner is None:
+        data = data.copy()
+    elif is_complex:
+      # split planes go straight into the result; no temporaries
+      data = np.empty(dtype=numpy_dtype, shape=(num_entries,))
+      real_dtype = self.api.classID_to_dtype(classID)
+      data.real[...] = self.api.as_ndarray(self.api.mxGetData(ptr),
+          (num_entries,), real_dtype)
+      data.imag[...] = self.api.as_ndarray(self.api.mxGetImagData(ptr),
+          (num_entries,), real_dtype)
+    else:
+      data = self.api.as_ndarray(self.api.mxGetData(ptr), (num_entries,),
+          numpy_dtype, owner)
+      if owner is None:
+        data = data.copy()
+
+    # set the arrays directly; the constructor is free to copy or recast
+    # them, which would defeat the point
+    to_return = csc_matrix(dims, dtype=numpy_dtype)
+    to_return.data = data
+    to_return.indices = row_ind
+    to_return.indptr = col
+    return to_return
 
-        vals = []
-        for r in xrange(dims[0]):
-          vals.append( str(tmp[r,0]).strip() )
-        to_ret = np.array(vals)
+  def __check_out(self, out, dims, dtype):
+    # make sure a caller-supplied output buffer can take the variable
+    # as-is; singleton dimensions are allowed to differ, so e.g. a 1-D
+    # array can receive an Nx1 MATLAB vector
+    import numpy as np
+    if not isinstance(out, np.ndarray):
+      raise TypeError("out must be an ndarray, not %s" % type(out))
+    if out.dtype != dtype:
+      raise TypeError("out has dtype %s but the MATLAB variable " \
+          "needs %s" % (out.dtype, dtype))
+    if [ d for d in out.shape if d != 1 ] != [ d for d in dims if d != 1 ]:
+      raise ValueError("out has shape %s but the MATLAB variable has " \
+          "size %s" % (out.shape, tuple(dims)))
+    if not out.flags.writeable:
+      raise ValueError("out is read-only")
+
+  def __mx_to_py(self, ptr, out=None, owner=None):
+    # decodes an mxArray of a fundamental type.  the caller still owns
+    # ptr, and nothing returned from here aliases its memory unless owner
+    # (an mx_array_owner of ptr) is given.
+
+    # get a bit of helpful info:
+    # - sparsity:
+    is_sparse = self.api.mxIsSparse(ptr)
+
+    # - dimensions:
+    num_dimensions = self.api.mxGetNumberOfDimensions(ptr)
+    dims_buf = self.api.mxGetDimensions(ptr)
+    dims = [ dims_buf[i] for i in xrange(num_dimensions) ]
+
+    # - classID, numpy datatype
+    classID = self.api.mxGetClassID(ptr)
+    is_string = classID == self.api.mxCHAR_CLASS
+    numpy_dtype = self.api.classID_to_dtype(classID)
+
+    # - real/complex?
+    is_complex = self.api.mxIsComplex(ptr)
+
+    if (is_string or is_sparse) and out is not None:
+      raise TypeError("out is only supported for dense numeric and " \
+          "logical variables")
+
+    if is_string:
+      # dense (MATLAB's limitation) string
+      import numpy as np
+      num_rows = dims[0]
+      num_cols = reduce(lambda x,y:x*y, dims[1:], 1)
+      chars = None
+      if num_rows * num_cols > 0:
+        chars = self.api.as_ndarray(self.api.mxGetChars(ptr),
+            (num_rows, num_cols), np.uint16)
+      return self.api.char_matrix_to_python(chars, num_rows)
+    elif is_sparse:
+      return self.__mx_to_sparse(ptr, dims, classID, is_complex, owner)
+    else:
+      # dense, non-string
+      import numpy as np
+      dims = tuple(dims)
 
-        if to_ret.shape[0] == 1:
-          # just one string
-          return to_ret[0]
+      if not is_complex:
+        to_ret_dtype = np.dtype(numpy_dtype)
+      else:
+        to_ret_dtype = np.result_type(np.dtype(numpy_dtype),
+            np.complex64)
+
+      # decode straight into the caller's buffer when we have one, so
+      # tight loops don't allocate a fresh array on every fetch
+      # MATLAB drops all-zero imaginary parts after most operations, so
+      # a complex out has to take a real variable too
+      real_into_complex = out is not None and not is_complex and \
+          to_ret_dtype.kind == "f" and isinstance(out, np.ndarray) and \
+          out.dtype == np.result_type(to_ret_dtype, np.complex64)
+
+      if out is not None:
+        self.__check_out(out, dims,
+            out.dtype if real_into_complex else to_ret_dtype)
+        to_ret = out
+      else:
+        to_ret = np.empty(dtype=to_ret_dtype, shape=dims, order="F")
+
+      def fill(dst, src):
+        dst[...] = src.reshape(dst.shape, order="F")
+
+      real_addr = self.api.mxGetData(ptr)
+      if real_addr == None:
+        # we attempted to get an empty array
+        return to_ret
+
+      if not is_complex:
+        # logicals come across as np.bool_ directly, since mxLogical
+        # and np.bool_ share a one-byte representation
+        src = self.api.as_ndarray(real_addr, dims, numpy_dtype)
+        if real_into_complex:
+          fill(to_ret.real, src)
+          to_ret.imag[...] = 0
         else:
-          return to_ret
-      elif is_sparse:
-        # sparse, non-string
-        from scipy.sparse import csc_matrix
-        import numpy as np
-        dims = tuple(dims)
-
-        row_ind_ptr = self.api.mxGetIr(ptr)
-        col_ptr = self.api.mxGetJc(ptr)
-        data_addr = self.api.mxGetData(ptr)
-
-        num_entries = self.api.mxGetNzmax(ptr)
-        sparse_shape = (num_entries,)
-        
-        data_ptr = ct.pointer(numpy_dtype.from_address(data_addr))
-
-        row_ind = np.ctypeslib.as_array(row_ind_ptr, shape=sparse_shape)
-        row_ind = np.array(row_ind, dtype=np.int, copy=True)
-        col = np.ctypeslib.as_array(col_ptr, shape=(dims[1]+1,))
-        col = np.array(col, dtype=np.int, copy=True)
-        col[-1] = num_entries
-        data = np.ctypeslib.as_array(data_ptr,
-            shape=sparse_shape).copy()
-
-        if is_complex:
-          imag_addr = self.api.mxGetImagData(ptr)
-          imag_ptr = ct.pointer(numpy_dtype.from_address(imag_addr))
-          imag = np.ctypeslib.as_array(imag_ptr,
-              shape=sparse_shape).copy()
-          data = data + 1j*imag
-
-        return csc_matrix( (data, row_ind, col), dims )
-
+          fill(to_ret, src)
       else:
-        # dense, non-string
-        import numpy as np
-        dims = tuple(dims)
-
-        real_addr = self.api.mxGetData(ptr)
-        if real_addr == None:
-          # we attempted to get an empty array
-          return np.empty(dtype=numpy_dtype, shape=())
-
-        real_ptr = ct.pointer(numpy_dtype.from_address(real_addr))
-        real = np.ctypeslib.as_array(real_ptr, shape=dims)
-
-        if is_complex:
-          imag_addr = self.api.mxGetImagData(ptr)
-          imag_ptr = ct.pointer(numpy_dtype.from_address(imag_addr))
-          imag = np.ctypeslib.as_array(imag_ptr, shape=dims)
-          real = 1j*imag + real
-
-        real = np.array(real, order="F", copy=True)
-        if len(real) == 1:
-          return real.flat[0]
+        interleaved_addr = self.api.interleaved_complex_data(ptr,
+            classID)
+        if interleaved_addr is not None:
+          fill(to_ret, self.api.as_ndarray(interleaved_addr, dims,
+              to_ret_dtype))
         else:
-          return real
-    except Exception, e:
-      raise e
-    finally:
-      if ptr is not None and ptr != 0:
-        self.api.mxDestroyArray(ptr)
+          # split planes: fill the complex array in place rather than
+          # building 1j*imag + real out of temporaries
+          fill(to_ret.real, self.api.as_ndarray(real_addr, dims,
+              numpy_dtype))
+          fill(to_ret.imag, self.api.as_ndarray(
+              self.api.mxGetImagData(ptr), dims, numpy_dtype))
+
+      if out is None and to_ret.size == 1:
+        return to_ret.flat[0]
+      else:
+        return to_ret
 
-  def get_proxy(self, var_name):
+  def get_proxy(self, var_name, num_bytes=None):
     """Returns a lightweight object that "proxies" an object in MATLAB.
 
     This function returns a lightweight object that simply stores the
@@ -1091,12 +2526,137 @@ class engine(object):
 
     No check is made to ensure that the given variable name is valid in
     the MATLAB workspace.  Things could explore horribly upon misuse.
+
+    The variable counts against workspace_budget.  num_bytes is its size
+    if known; otherwise it's looked up with whos when a budget is set.
     
     """
+    self.__evicted.discard(var_name)
+    entry = self.__resident.pop(var_name, None)
+    if entry is None:
+      entry = { "bytes" : None, "spill_path" : None }
+    if num_bytes is not None:
+      entry["bytes"] = num_bytes
+    self.__resident[var_name] = entry
+    self.__enforce_budget(set([ var_name ]))
     return engine_object_proxy(self, var_name)
 
+  def ensure_resident(self, *var_names):
+    """Marks proxied variables as just used, reloading any that were
+    spilled.  None of var_names is evicted to make room for the others.
+    Names that aren't proxied are ignored; names that were cleared to
+    stay within workspace_budget raise NameError.
+
+    """
+    reloaded = False
+    for var_name in var_names:
+      if var_name in self.__evicted:
+        raise NameError("proxied variable %s was cleared to stay " \
+            "within workspace_budget" % var_name)
+      entry = self.__resident.pop(var_name, None)
+      if entry is None:
+        continue
+      self.__resident[var_name] = entry
+      if entry["spill_path"] is not None:
+        self.load_mat(entry["spill_path"])
+        os.remove(entry["spill_path"])
+        entry["spill_path"] = None
+        reloaded = True
+    if reloaded:
+      self.__enforce_budget(set(var_names))
+
+  def __get_resident_bytes(self):
+    return sum([ e["bytes"] for e in self.__resident.values() \
+        if e["spill_path"] is None and e["bytes"] is not None ])
+  resident_bytes = property(__get_resident_bytes)
+
+  def __enforce_budget(self, keep):
+    # evicts least recently used proxies, sparing the names in keep,
+    # until we're back under budget
+    if self.workspace_budget is None:
+      return
+    total = 0
+    for (name, entry) in self.__resident.items():
+      if entry["spill_path"] is None:
+        if entry["bytes"] is None:
+          entry["bytes"] = self.__workspace_bytes(name)
+        total += entry["bytes"]
+    for name in list(self.__resident.keys()):
+      if total <= self.workspace_budget:
+        break
+      entry = self.__resident[name]
+      if name in keep or entry["spill_path"] is not None:
+        continue
+      self.__evict(name)
+      total -= entry["bytes"]
+
+  def __workspace_bytes(self, var_name):
+    tmp_name = self.temp_name()
+    self("%s = whos('%s'); %s = sum([%s.bytes]);" % (tmp_name, var_name,
+      tmp_name, tmp_name))
+    try:
+      # a double; no need for get_variable's class lookup
+      return int(self.get_plain_variable(tmp_name))
+    finally:
+      self("clear %s;" % tmp_name)
+
+  def __evict(self, var_name):
+    if self.spill_evicted:
+      if self.__spill_directory is None:
+        self.__spill_directory = tempfile.mkdtemp(prefix="matropylis")
+        self.__leftovers.directories.append(self.__spill_directory)
+      path = os.path.join(self.__spill_directory, "%s.mat" % var_name)
+      # -v7.3 because -v6 can't hold variables over 2GB
+      self("save('%s', '%s', '-v7.3');" % (path.replace("'", "''"),
+        var_name))
+      self.__resident[var_name]["spill_path"] = path
+    else:
+      # remembered, so using the proxy later fails loudly
+      del self.__resident[var_name]
+      self.__evicted.add(var_name)
+    self("clear %s;" % var_name)
+
+  def load_mat(self, path):
+    """Loads every variable in the MAT-file at path into the workspace.
+
+    This is a single eval, so it's a cheap way to move a lot of data at
+    once, e.g. a file prepared with matfile.write_mat.
+
+    """
+    self("load('%s');" % path.replace("'", "''"))
+
+  def save_mat(self, path, names):
+    """Saves the named workspace variables to the MAT-file at path.
+
+    The file is written uncompressed ('-v6') so that matfile.read_mat can
+    memory-map it rather than inflating it.
+
+    """
+    self("save('%s', %s, '-v6');" % (path.replace("'", "''"),
+      ", ".join([ "'%s'" % n for n in names ])))
+
+  def register_callback(self, name, func):
+    """Make the Python callable func available in MATLAB as name.
+
+    Calling name(...) in MATLAB ships the arguments to Python over a
+    local pipe, calls func with them and ships its return value(s)
+    back.  Numeric, logical and char arrays are supported in both
+    directions.  func runs while the engine is busy evaluating the
+    MATLAB code that called it, so it must not use the engine itself.
+
+    """
+    self.__start_callback_server()
+    self.__callback_server.register(name, func)
+    # make sure MATLAB notices the newly written shim
+    self("rehash;")
+
   def __start_callback_server(self):
-    # notion -- this gives us a tool to make Python functions available
-    # from MATLAB
-    pass
+    # this gives us a tool to make Python functions available from
+    # MATLAB; see callback.py for the protocol
+    if self.__callback_server is not None:
+      return
+    from callback import callback_server
+    self.__callback_server = callback_server(self.api)
+    self.__leftovers.callback_servers.append(self.__callback_server)
+    self("addpath('%s');" % self.__callback_server.directory)
 
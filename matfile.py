@@ -0,0 +1,324 @@
+import mmap
+import struct
+import time
+import zlib
+
+from engine import matlab
+
+# MAT-file v5 data types (see MathWorks' "MAT-File Format" document)
+miINT8 = 1
+miUINT8 = 2
+miINT16 = 3
+miUINT16 = 4
+miINT32 = 5
+miUINT32 = 6
+miSINGLE = 7
+miDOUBLE = 9
+miINT64 = 12
+miUINT64 = 13
+miMATRIX = 14
+miCOMPRESSED = 15
+miUTF8 = 16
+miUTF16 = 17
+miUTF32 = 18
+
+# array classes that only show up in files; the numeric ones are the
+# same as matlab.mx*_CLASS
+mxCELL_CLASS = 1
+mxSTRUCT_CLASS = 2
+mxOBJECT_CLASS = 3
+mxCHAR_CLASS = 4
+mxSPARSE_CLASS = 5
+
+# array flags, as they sit in the first word of the flags subelement
+_COMPLEX_FLAG = 0x0800
+_LOGICAL_FLAG = 0x0200
+
+_mi_to_dtype = { miINT8 : "i1", miUINT8 : "u1", miINT16 : "i2",
+    miUINT16 : "u2", miINT32 : "i4", miUINT32 : "u4", miSINGLE : "f4",
+    miDOUBLE : "f8", miINT64 : "i8", miUINT64 : "u8", miUTF8 : "u1",
+    miUTF16 : "u2", miUTF32 : "u4" }
+
+def write_mat(path, variables):
+  """Write a dict of name -> value to a MAT v5 file at path.
+
+  Numeric, logical and complex arrays, strings (and lists/arrays of
+  strings), scipy sparse matrices, dicts (as structs) and object arrays
+  (as cells) are supported.  Data is written uncompressed, so the file
+  can be memory-mapped by read_mat and loaded by MATLAB with a single
+  load().  This only needs numpy, so files can be prepared in worker
+  processes with no engine around.
+
+  """
+  with open(path, "wb") as f:
+    text = "MATLAB 5.0 MAT-file, Platform: matropylis, Created on: %s" % \
+        time.asctime()
+    f.write(struct.pack("<116s8sH2s", text, "", 0x0100, "IM"))
+    for (name, value) in variables.items():
+      for chunk in _matrix_element(name, value):
+        _write_chunk(f, chunk)
+
+def read_mat(path, use_mmap=True):
+  """Read every variable in the MAT v5 file at path into a dict.
+
+  With use_mmap, the file is memory-mapped and uncompressed numeric
+  arrays whose stored type matches their class are returned as
+  read-only, zero-copy views of the map.  Compressed (-v7) variables are
+  inflated into memory.  MATLAB objects aren't supported.
+
+  """
+  with open(path, "rb") as f:
+    if use_mmap:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      buf = f.read()
+
+  if buf[126:128] == "IM":
+    endian = "<"
+  else:
+    endian = ">"
+
+  to_return = {}
+  pos = 128
+  while pos < len(buf):
+    (mi_type, num_bytes, data_pos, pos) = _read_tag(buf, pos, endian)
+    if mi_type == miCOMPRESSED:
+      inner = zlib.decompress(buf[data_pos:data_pos+num_bytes])
+      (mi_type, num_bytes, data_pos, next_pos) = _read_tag(inner, 0, endian)
+      (name, value) = _read_matrix(inner, data_pos, endian)
+    elif mi_type == miMATRIX:
+      (name, value) = _read_matrix(buf, data_pos, endian)
+    else:
+      continue
+    to_return[name] = value
+  return to_return
+
+def _write_chunk(f, chunk):
+  import numpy as np
+  if isinstance(chunk, np.ndarray):
+    # already in file order; tofile avoids building a string copy
+    chunk.tofile(f)
+  else:
+    f.write(chunk)
+
+def _chunk_size(chunk):
+  import numpy as np
+  if isinstance(chunk, np.ndarray):
+    return chunk.nbytes
+  return len(chunk)
+
+def _element(mi_type, data):
+  # a tagged data element, padded out to a multiple of 8 bytes.  data is
+  # either a string or a C-contiguous ndarray laid out in file order.
+  num_bytes = _chunk_size(data)
+  chunks = [ struct.pack("<II", mi_type, num_bytes), data ]
+  if num_bytes % 8 != 0:
+    chunks.append("\0" * (8 - num_bytes % 8))
+  return chunks
+
+def _mi_type(dtype):
+  for (mi_type, code) in _mi_to_dtype.items():
+    if mi_type < miUTF8 and dtype.str[1:] == code:
+      return mi_type
+  raise TypeError("no MAT-file data type for %s" % dtype)
+
+def _column_major(array, dtype=None):
+  # the transpose of a column-major array is C-ordered, which is how
+  # chunks get written
+  import numpy as np
+  return np.ascontiguousarray(array.T, dtype=dtype)
+
+def _matrix_element(name, value):
+  subelements = _matrix_subelements(name, value)
+  num_bytes = sum([ _chunk_size(c) for c in subelements ])
+  return [ struct.pack("<II", miMATRIX, num_bytes) ] + subelements
+
+def _matrix_header(class_ID, flags, dims, name, nzmax=0):
+  import numpy as np
+  return _element(miUINT32, struct.pack("<II", class_ID | flags, nzmax)) + \
+      _element(miINT32, np.asarray(dims, dtype="<i4")) + \
+      _element(miINT8, name)
+
+def _matrix_subelements(name, value):
+  import numpy as np
+
+  if isinstance(value, dict):
+    # 1x1 struct
+    field_names = [ str(k) for k in value.keys() ]
+    name_len = max([ len(k) for k in field_names ] + [ 0 ]) + 1
+    chunks = _matrix_header(mxSTRUCT_CLASS, 0, (1, 1), name)
+    chunks.append(struct.pack("<HHi", miINT32, 4, name_len))
+    chunks.extend(_element(miINT8, "".join([ k.ljust(name_len, "\0") \
+        for k in field_names ])))
+    for k in value.keys():
+      chunks.extend(_matrix_element("", value[k]))
+    return chunks
+
+  try:
+    from scipy.sparse import issparse
+  except ImportError:
+    issparse = lambda x: False
+  if issparse(value):
+    csc = value.tocsc()
+    csc.sum_duplicates()
+    is_logical = csc.dtype == np.bool_
+    is_complex = csc.dtype.kind == "c"
+    flags = (_LOGICAL_FLAG if is_logical else 0) | \
+        (_COMPLEX_FLAG if is_complex else 0)
+    chunks = _matrix_header(mxSPARSE_CLASS, flags, csc.shape, name,
+        max(csc.nnz, 1))
+    chunks.extend(_element(miINT32, np.asarray(csc.indices, dtype="<i4")))
+    chunks.extend(_element(miINT32, np.asarray(csc.indptr, dtype="<i4")))
+    if is_logical:
+      chunks.extend(_element(miUINT8, np.asarray(csc.data, dtype="u1")))
+    else:
+      chunks.extend(_element(miDOUBLE,
+        np.asarray(csc.data.real, dtype="<f8")))
+      if is_complex:
+        chunks.extend(_element(miDOUBLE,
+          np.asarray(csc.data.imag, dtype="<f8")))
+    return chunks
+
+  if isinstance(value, (int, long, float, complex, np.generic)):
+    # the same rule as engine.set_variable, so staging data through a
+    # file doesn't change what MATLAB makes of it
+    value = matlab.scalar_array(value)
+  array = np.asarray(value)
+  if array.dtype.kind in "SU":
+    codes = matlab.strings_to_char_codes(array)
+    codes[codes == 0] = ord(" ")
+    chunks = _matrix_header(mxCHAR_CLASS, 0, codes.shape, name)
+    chunks.extend(_element(miUINT16, _column_major(codes, "<u2")))
+    return chunks
+
+  if len(array.shape) == 0:
+    array = array.reshape((1, 1))
+  elif len(array.shape) == 1:
+    array = array.reshape((array.shape[0], 1))
+
+  if array.dtype == object:
+    chunks = _matrix_header(mxCELL_CLASS, 0, array.shape, name)
+    for elem in array.flatten(order="F"):
+      chunks.extend(_matrix_element("", elem))
+    return chunks
+
+  if array.dtype == np.bool_:
+    chunks = _matrix_header(matlab.mxUINT8_CLASS, _LOGICAL_FLAG,
+        array.shape, name)
+    chunks.extend(_element(miUINT8, _column_major(array.view(np.uint8))))
+    return chunks
+
+  class_ID = matlab.dtype_to_classID(array.dtype)
+  real_dtype = np.dtype(matlab.classID_to_dtype(class_ID)).newbyteorder("<")
+  mi_type = _mi_type(real_dtype)
+  is_complex = array.dtype.kind == "c"
+  chunks = _matrix_header(class_ID, _COMPLEX_FLAG if is_complex else 0,
+      array.shape, name)
+  chunks.extend(_element(mi_type, _column_major(array.real, real_dtype)))
+  if is_complex:
+    chunks.extend(_element(mi_type, _column_major(array.imag, real_dtype)))
+  return chunks
+
+def _read_tag(buf, pos, endian):
+  # returns (type, byte count, data offset, offset of the next element)
+  (mi_type, num_bytes) = struct.unpack_from(endian + "II", buf, pos)
+  if mi_type >> 16 != 0:
+    # small data element: up to 4 bytes packed in with the tag
+    return (mi_type & 0xffff, mi_type >> 16, pos+4, pos+8)
+  next_pos = pos + 8 + num_bytes
+  if mi_type != miCOMPRESSED and num_bytes % 8 != 0:
+    next_pos += 8 - num_bytes % 8
+  return (mi_type, num_bytes, pos+8, next_pos)
+
+def _read_data(buf, pos, endian):
+  # reads one numeric subelement as a view into buf
+  import numpy as np
+  (mi_type, num_bytes, data_pos, next_pos) = _read_tag(buf, pos, endian)
+  dtype = np.dtype(endian + _mi_to_dtype[mi_type])
+  data = np.frombuffer(buf, dtype, num_bytes // dtype.itemsize, data_pos)
+  return (mi_type, data, next_pos)
+
+def _read_matrix(buf, pos, endian):
+  import numpy as np
+  (mi_type, flags_data, pos) = _read_data(buf, pos, endian)
+  class_ID = int(flags_data[0]) & 0xff
+  flags = int(flags_data[0])
+  (mi_type, dims, pos) = _read_data(buf, pos, endian)
+  dims = tuple([ int(d) for d in dims ])
+  (mi_type, num_bytes, data_pos, pos) = _read_tag(buf, pos, endian)
+  name = str(buf[data_pos:data_pos+num_bytes])
+  count = reduce(lambda x,y:x*y, dims, 1)
+
+  if class_ID == mxCELL_CLASS:
+    value = np.empty(dtype=object, shape=(count,))
+    for i in xrange(count):
+      (mi_type, num_bytes, data_pos, pos) = _read_tag(buf, pos, endian)
+      value[i] = _read_matrix(buf, data_pos, endian)[1]
+    return (name, value.reshape(dims, order="F"))
+
+  if class_ID == mxSTRUCT_CLASS:
+    (mi_type, name_len, pos) = _read_data(buf, pos, endian)
+    name_len = int(name_len[0])
+    (mi_type, num_bytes, data_pos, pos) = _read_tag(buf, pos, endian)
+    raw_names = str(buf[data_pos:data_pos+num_bytes])
+    field_names = [ raw_names[i:i+name_len].rstrip("\0") \
+        for i in xrange(0, num_bytes, name_len) ]
+    records = np.empty(dtype=object, shape=(count,))
+    for i in xrange(count):
+      record = {}
+      for field in field_names:
+        (mi_type, num_bytes, data_pos, pos) = _read_tag(buf, pos, endian)
+        record[field] = _read_matrix(buf, data_pos, endian)[1]
+      records[i] = record
+    if count == 1:
+      return (name, records[0])
+    return (name, records.reshape(dims, order="F"))
+
+  if class_ID == mxSPARSE_CLASS:
+    from scipy.sparse import csc_matrix
+    (mi_type, row_ind, pos) = _read_data(buf, pos, endian)
+    (mi_type, col, pos) = _read_data(buf, pos, endian)
+    nnz = int(col[-1])
+    (mi_type, data, pos) = _read_data(buf, pos, endian)
+    data = data[:nnz]
+    if flags & _COMPLEX_FLAG:
+      (mi_type, imag, pos) = _read_data(buf, pos, endian)
+      data = data + 1j*imag[:nnz]
+    elif flags & _LOGICAL_FLAG:
+      data = data.astype(np.bool_)
+    return (name, csc_matrix((data, row_ind[:nnz], col), dims))
+
+  if class_ID == mxCHAR_CLASS:
+    (mi_type, chars, pos) = _read_data(buf, pos, endian)
+    if mi_type == miUTF8:
+      text = chars.tostring().decode("utf-8")
+      chars = np.frombuffer(text.encode("utf-16-le"), "<u2")
+    num_rows = dims[0]
+    chars = chars.reshape((num_rows, count // max(num_rows, 1)), order="F")
+    return (name, matlab.char_matrix_to_python(chars, num_rows))
+
+  if class_ID < matlab.mxDOUBLE_CLASS or class_ID > matlab.mxUINT64_CLASS:
+    raise TypeError("can't read '%s' (MAT-file class %d)" % \
+        (name, class_ID))
+
+  # numeric.  MATLAB may store data in a narrower type than its class,
+  # in which case we have to convert; otherwise this is a view.
+  dtype = np.dtype(matlab.classID_to_dtype(class_ID))
+  (mi_type, real, pos) = _read_data(buf, pos, endian)
+  if flags & _LOGICAL_FLAG:
+    dtype = np.dtype(np.bool_)
+  if real.dtype.str[1:] != dtype.str[1:]:
+    real = real.astype(dtype)
+  if flags & _COMPLEX_FLAG:
+    (mi_type, imag, pos) = _read_data(buf, pos, endian)
+    value = np.empty(dtype=np.result_type(dtype, np.complex64),
+        shape=(count,))
+    value.real[...] = real
+    value.imag[...] = imag
+  else:
+    value = real
+  value = value.reshape(dims, order="F")
+
+  if value.size == 1:
+    return (name, value.flat[0])
+  return (name, value)
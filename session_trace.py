@@ -0,0 +1,397 @@
+import collections
+import struct
+import timeit
+
+# a trace is a short header followed by one record per engine operation.
+# everything is little-endian.  a record is
+#
+#   uint8 op, uint8 flags, double start (seconds since recording began),
+#   double duration (seconds)
+#
+# followed by, for evals, a uint32 byte count and the UTF-8 text, and for
+# set/get, a variable:
+#
+#   uint16 byte count, name, then either
+#   uint8 length, dtype string, uint8 ndim, uint64 dims[ndim]
+#   [ uint64 byte count, raw column-major data ]     (with _PAYLOAD)
+#
+# when the value is a plain array (_DESCRIBED), or a uint8 length and the
+# Python type name otherwise.  the bulk set_many/get_many records have no
+# flags of their own; they're followed by a uint32 count and that many
+# variables, each preceded by its uint8 flags.
+_MAGIC = "MTRC"
+_VERSION = 2
+
+EVAL = 0
+SET = 1
+GET = 2
+SET_MANY = 3
+GET_MANY = 4
+op_names = { EVAL : "eval", SET : "set", GET : "get",
+    SET_MANY : "set_many", GET_MANY : "get_many" }
+
+_DESCRIBED = 0x01
+_PAYLOAD = 0x02
+
+trace_record = collections.namedtuple("trace_record", [ "op", "start",
+  "duration", "subject", "dtype", "shape", "payload", "type_name" ])
+
+class trace_recorder(object):
+  def __init__(self, path, payloads=False):
+    """Writes engine operations to a binary trace at path.
+
+    The engine calls record_eval/record_set/record_get (and the bulk
+    record_set_many/record_get_many) around the real operations.  Only
+    the outermost operation is recorded, so e.g. the evals get_variable
+    makes internally don't show up; replaying the get reproduces them.
+    With payloads, the data of numeric, logical and char arrays is
+    stored too.
+
+    """
+    self.payloads = payloads
+    self.__file = open(path, "wb")
+    self.__file.write(_MAGIC + struct.pack("<H", _VERSION))
+    self.__depth = 0
+    self.__origin = timeit.default_timer()
+
+  def close(self):
+    if self.__file is not None:
+      self.__file.close()
+      self.__file = None
+
+  def record_eval(self, text, func):
+    return self.__record(EVAL, text, func, (text,))
+
+  def record_set(self, name, value, func):
+    return self.__record(SET, name, func, (name, value), value)
+
+  def record_get(self, name, func, *args):
+    return self.__record(GET, name, func, (name,) + args, None, True)
+
+  def record_set_many(self, variables, func):
+    # variables is a dict of name -> value, so it's recorded in the
+    # order func will see it
+    return self.__record(SET_MANY, variables.keys(), func, (variables,),
+        variables.values())
+
+  def record_get_many(self, names, func):
+    names = list(names)
+    return self.__record(GET_MANY, names, func, (names,), None, True)
+
+  def __record(self, op, subject, func, args, value=None,
+      value_is_result=False):
+    if self.__depth > 0 or self.__file is None:
+      return func(*args)
+    self.__depth += 1
+    try:
+      start = timeit.default_timer()
+      result = func(*args)
+      duration = timeit.default_timer() - start
+    finally:
+      self.__depth -= 1
+    if value_is_result:
+      value = result
+    self.__write(op, start - self.__origin, duration, subject, value)
+    return result
+
+  def __write(self, op, start, duration, subject, value):
+    if op == EVAL:
+      if isinstance(subject, unicode):
+        subject = subject.encode("utf-8")
+      self.__file.write(struct.pack("<BBddI", op, 0, start, duration,
+        len(subject)) + subject)
+      return
+
+    if op in (SET_MANY, GET_MANY):
+      chunks = [ struct.pack("<BBddI", op, 0, start, duration,
+        len(subject)) ]
+      for (name, v) in zip(subject, value):
+        (flags, variable) = self.__variable(name, v)
+        chunks.append(struct.pack("<B", flags))
+        chunks.extend(variable)
+    else:
+      (flags, variable) = self.__variable(subject, value)
+      chunks = [ struct.pack("<BBdd", op, flags, start, duration) ]
+      chunks.extend(variable)
+    self.__file.write("".join(chunks))
+
+  def __variable(self, name, value):
+    # (flags, chunks) describing one variable
+    if isinstance(name, unicode):
+      name = name.encode("utf-8")
+    array = _plain_array(value)
+    flags = 0
+    if array is not None:
+      flags |= _DESCRIBED
+      if self.payloads:
+        flags |= _PAYLOAD
+    chunks = [ struct.pack("<H", len(name)), name ]
+    if array is not None:
+      dtype_str = array.dtype.str
+      chunks.append(struct.pack("<B", len(dtype_str)) + dtype_str)
+      chunks.append(struct.pack("<B%dQ" % array.ndim, array.ndim,
+        *array.shape))
+      if self.payloads:
+        data = array.tostring(order="F")
+        chunks.append(struct.pack("<Q", len(data)))
+        chunks.append(data)
+    else:
+      type_name = type(value).__name__
+      chunks.append(struct.pack("<B", len(type_name)) + type_name)
+    return (flags, chunks)
+
+def _plain_array(value):
+  # the value as an array, if it's something a trace can describe
+  import numpy as np
+  if value is None or hasattr(value, "matlab_name"):
+    return None
+  try:
+    array = np.asarray(value)
+  except Exception:
+    return None
+  if array.dtype.kind not in "biufcSU":
+    return None
+  return array
+
+def read_trace(path):
+  """Yields the trace_records in the trace at path, in order.
+
+  For set_many and get_many records, subject is a tuple of the variable
+  names, and dtype, shape, payload and type_name are tuples with one
+  entry per name.
+
+  """
+  with open(path, "rb") as f:
+    buf = f.read()
+  if buf[:4] != _MAGIC:
+    raise ValueError("%s isn't an engine trace" % path)
+  (version,) = struct.unpack_from("<H", buf, 4)
+  if version not in (1, _VERSION):
+    raise ValueError("unsupported trace version %d" % version)
+
+  pos = 6
+  while pos < len(buf):
+    (op, flags, start, duration) = struct.unpack_from("<BBdd", buf, pos)
+    pos += 18
+    dtype = shape = payload = type_name = None
+    if op == EVAL:
+      (length,) = struct.unpack_from("<I", buf, pos)
+      pos += 4
+      subject = buf[pos:pos+length].decode("utf-8")
+      pos += length
+      yield trace_record(op, start, duration, subject, dtype, shape,
+          payload, type_name)
+      continue
+
+    if op in (SET_MANY, GET_MANY):
+      (count,) = struct.unpack_from("<I", buf, pos)
+      pos += 4
+      variables = []
+      for i in xrange(count):
+        (flags,) = struct.unpack_from("<B", buf, pos)
+        (variable, pos) = _read_variable(buf, pos+1, flags)
+        variables.append(variable)
+      (subject, dtype, shape, payload, type_name) = \
+          tuple(zip(*variables)) if count > 0 else ((),) * 5
+    else:
+      ((subject, dtype, shape, payload, type_name), pos) = \
+          _read_variable(buf, pos, flags)
+    yield trace_record(op, start, duration, subject, dtype, shape, payload,
+        type_name)
+
+def _read_variable(buf, pos, flags):
+  # ((name, dtype, shape, payload, type_name), next position)
+  import numpy as np
+  dtype = shape = payload = type_name = None
+  (length,) = struct.unpack_from("<H", buf, pos)
+  pos += 2
+  name = buf[pos:pos+length]
+  pos += length
+  (length,) = struct.unpack_from("<B", buf, pos)
+  pos += 1
+  if flags & _DESCRIBED:
+    dtype = np.dtype(buf[pos:pos+length])
+    pos += length
+    (ndim,) = struct.unpack_from("<B", buf, pos)
+    pos += 1
+    shape = struct.unpack_from("<%dQ" % ndim, buf, pos)
+    pos += 8 * ndim
+    if flags & _PAYLOAD:
+      (num_bytes,) = struct.unpack_from("<Q", buf, pos)
+      pos += 8
+      payload = np.frombuffer(buf, dtype, num_bytes // dtype.itemsize,
+          pos).reshape(shape, order="F")
+      pos += num_bytes
+  else:
+    type_name = buf[pos:pos+length]
+    pos += length
+  return ((name, dtype, shape, payload, type_name), pos)
+
+def recorded_latencies(path):
+  """The latencies stored in the trace at path, as a dict of operation
+  name ("eval", "set", "get") to a list of seconds."""
+  to_return = dict([ (name, []) for name in op_names.values() ])
+  for record in read_trace(path):
+    to_return[op_names[record.op]].append(record.duration)
+  return to_return
+
+def _stand_in_value(dtype, shape, payload, use_payloads):
+  # what to push (or expect back) for a variable in a set/get record
+  import numpy as np
+  if use_payloads and payload is not None:
+    return payload
+  if dtype is None:
+    return None
+  return np.zeros(shape, dtype=dtype, order="F")
+
+class replay_result(object):
+  def __init__(self):
+    """Latencies of a replayed trace, by operation name, in seconds.
+
+    skipped counts variables in set records that couldn't be replayed
+    because the trace didn't describe their value; errors counts
+    operations that raised.
+
+    """
+    self.latencies = dict([ (name, []) for name in op_names.values() ])
+    self.skipped = 0
+    self.errors = 0
+
+  def summary(self):
+    return summarize_latencies(self.latencies)
+
+  def report(self):
+    return latency_report(self.latencies)
+
+  def __str__(self):
+    return self.report()
+
+def replay_trace(path, backend, use_payloads=True):
+  """Re-drives the trace at path against backend.
+
+  backend is an engine or anything with the same eval, set_variable,
+  get_variable, set_variables and get_variables methods, e.g. a
+  stand_in_backend.  Values are pushed from the trace's payloads when it
+  has them (and use_payloads is set), and as zeros of the recorded shape
+  and dtype otherwise.  Returns a replay_result.
+
+  """
+  to_return = replay_result()
+  for record in read_trace(path):
+    if record.op == EVAL:
+      func = backend.eval
+      args = (record.subject,)
+    elif record.op in (SET, SET_MANY):
+      if record.op == SET:
+        variables = [ (record.subject, record.dtype, record.shape,
+          record.payload) ]
+      else:
+        variables = zip(record.subject, record.dtype, record.shape,
+            record.payload)
+      values = {}
+      for (name, dtype, shape, payload) in variables:
+        value = _stand_in_value(dtype, shape, payload, use_payloads)
+        if value is None:
+          to_return.skipped += 1
+        else:
+          values[name] = value
+      if len(values) == 0:
+        continue
+      if record.op == SET:
+        func = backend.set_variable
+        args = values.items()[0]
+      else:
+        func = backend.set_variables
+        args = (values,)
+    else:
+      if record.op == GET:
+        variables = [ (record.subject, record.dtype, record.shape,
+          record.payload) ]
+      else:
+        variables = zip(record.subject, record.dtype, record.shape,
+            record.payload)
+      if hasattr(backend, "expect"):
+        for (name, dtype, shape, payload) in variables:
+          backend.expect(name,
+              _stand_in_value(dtype, shape, payload, use_payloads))
+      if record.op == GET:
+        func = backend.get_variable
+        args = (record.subject,)
+      else:
+        func = backend.get_variables
+        args = (list(record.subject),)
+
+    start = timeit.default_timer()
+    try:
+      func(*args)
+    except Exception:
+      to_return.errors += 1
+      continue
+    to_return.latencies[op_names[record.op]].append(
+        timeit.default_timer() - start)
+  return to_return
+
+class stand_in_backend(object):
+  def __init__(self):
+    """A local stand-in for engine when replaying traces without MATLAB.
+
+    Pushes copy values into Fortran-ordered arrays and fetches copy them
+    back out, roughly the Python-side share of marshalling; evals do
+    nothing.  Variables a replayed eval would have created in MATLAB
+    come from the trace through expect().
+
+    """
+    self.workspace = {}
+
+  def eval(self, text):
+    pass
+
+  def set_variable(self, name, value):
+    import numpy as np
+    self.workspace[name] = np.array(value, order="F")
+
+  def expect(self, name, value):
+    if name not in self.workspace and value is not None:
+      self.workspace[name] = value
+
+  def get_variable(self, name):
+    import numpy as np
+    return np.array(self.workspace[name], order="F")
+
+  def set_variables(self, variables):
+    for (name, value) in variables.items():
+      self.set_variable(name, value)
+
+  def get_variables(self, names):
+    return [ self.get_variable(name) for name in names ]
+
+def summarize_latencies(latencies):
+  """Count, mean and percentiles of each operation's latencies.
+
+  latencies maps operation names to lists of seconds, as returned by
+  recorded_latencies or replay_result.latencies.  Returns a dict of
+  operation name to a dict with "count", "mean", "p50", "p90", "p99"
+  and "max"; operations with no samples are left out.
+
+  """
+  import numpy as np
+  to_return = {}
+  for (name, samples) in latencies.items():
+    if len(samples) == 0:
+      continue
+    samples = np.asarray(samples)
+    (p50, p90, p99) = np.percentile(samples, [ 50, 90, 99 ])
+    to_return[name] = { "count" : len(samples), "mean" : samples.mean(),
+        "p50" : p50, "p90" : p90, "p99" : p99, "max" : samples.max() }
+  return to_return
+
+def latency_report(latencies):
+  summary = summarize_latencies(latencies)
+  columns = ("count", "mean", "p50", "p90", "p99", "max")
+  lines = [ "%-8s %8s %12s %12s %12s %12s %12s" % (("op",) + columns) ]
+  for name in sorted(summary.keys()):
+    stats = summary[name]
+    lines.append("%-8s %8d %12.6f %12.6f %12.6f %12.6f %12.6f" % \
+        ((name, stats["count"]) + \
+          tuple([ stats[c] for c in columns[1:] ])))
+  return "\n".join(lines)
@@ -0,0 +1,97 @@
+import os
+import os.path
+import struct
+import sys
+import traceback
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+  __file__))))
+import callback
+from engine import matlab
+
+class callback_framing_test(unittest.TestCase):
+  # the framing of callback arguments and results needs no MATLAB; the
+  # matlab class itself stands in for the loaded API
+
+  def round_trip(self, value):
+    message = "".join(callback._encode_array(matlab, value))
+    (decoded, pos) = callback._decode_array(matlab, message, 0)
+    self.assertEqual(len(message), pos)
+    return decoded
+
+  def test_real(self):
+    value = np.arange(12.0).reshape((3, 4))
+    decoded = self.round_trip(value)
+    np.testing.assert_array_equal(value, decoded)
+    self.assertEqual(np.double, decoded.dtype)
+
+  def test_complex(self):
+    value = (np.arange(6) + 1j*np.arange(6)[::-1]).reshape((2, 3))
+    decoded = self.round_trip(value)
+    np.testing.assert_array_equal(value, decoded)
+    self.assertEqual(np.complex128, decoded.dtype)
+
+    value = value.astype(np.complex64)
+    decoded = self.round_trip(value)
+    np.testing.assert_array_equal(value, decoded)
+    self.assertEqual(np.complex64, decoded.dtype)
+
+  def test_nd_int32(self):
+    value = np.arange(24, dtype=np.int32).reshape((2, 3, 4))
+    decoded = self.round_trip(value)
+    np.testing.assert_array_equal(value, decoded)
+    self.assertEqual(np.int32, decoded.dtype)
+
+    value = np.asfortranarray(value)
+    np.testing.assert_array_equal(value, self.round_trip(value))
+
+  def test_logical(self):
+    value = np.array([[True, False], [False, True]])
+    decoded = self.round_trip(value)
+    np.testing.assert_array_equal(value, decoded)
+    self.assertEqual(np.bool_, decoded.dtype)
+
+  def test_char(self):
+    self.assertEqual(u"hello", self.round_trip("hello"))
+    self.assertEqual(u"caf\xe9", self.round_trip(u"caf\xe9"))
+    self.assertEqual(u"", self.round_trip(""))
+
+  def test_scalars(self):
+    # plain numbers go as doubles and come back as numpy scalars
+    decoded = self.round_trip(3)
+    self.assertEqual(3.0, decoded)
+    self.assertEqual(np.double, type(decoded))
+    self.assertEqual(2.5, self.round_trip(2.5))
+    self.assertEqual(1+2j, self.round_trip(1+2j))
+    self.assertEqual(np.bool_, type(self.round_trip(True)))
+    self.assertEqual(np.int32, type(self.round_trip(np.int32(7))))
+
+  def test_vector(self):
+    # 1-d arrays go as columns
+    decoded = self.round_trip(np.arange(3.0))
+    np.testing.assert_array_equal(np.arange(3.0).reshape((3, 1)), decoded)
+
+  def test_several_arrays(self):
+    message = "".join(callback._encode_array(matlab, np.arange(4.0)) + \
+        callback._encode_array(matlab, "ab"))
+    (first, pos) = callback._decode_array(matlab, message, 0)
+    (second, pos) = callback._decode_array(matlab, message, pos)
+    np.testing.assert_array_equal(np.arange(4.0).reshape((4, 1)), first)
+    self.assertEqual(u"ab", second)
+    self.assertEqual(len(message), pos)
+
+  def test_error_reply(self):
+    # a message that isn't valid UTF-8 mustn't stop MATLAB getting a reply
+    try:
+      raise ValueError("temp\xc3\xa9rature \xff")
+    except ValueError:
+      reply = callback._error_reply(traceback.format_exc())
+    self.assertEqual((1,), struct.unpack_from("<B", reply, 0))
+    text = reply[1:].decode("utf-8")
+    self.assertTrue(u"temp\xe9rature \ufffd" in text)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,170 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import scipy.io
+import scipy.sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+  __file__))))
+import matfile
+
+class matfile_round_trip_test(unittest.TestCase):
+  # matfile only needs numpy, so it's checked against scipy.io rather
+  # than MATLAB: files we write must load with loadmat, and files savemat
+  # writes must read back with read_mat.
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="matropylis_test")
+    self.path = os.path.join(self.directory, "test.mat")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def variables(self):
+    return {
+        "dense" : np.arange(12, dtype=np.double).reshape((3, 4)),
+        "c_ordered" : np.arange(24, dtype=np.single).reshape((2, 3, 4)),
+        "fortran" : np.asfortranarray(np.arange(6,
+          dtype=np.int32).reshape((2, 3))),
+        "uint" : np.array([[1, 2, 65535]], dtype=np.uint16),
+        "int64" : np.array([[-(2**40), 2**40]], dtype=np.int64),
+        "logical" : np.array([[True, False], [False, True]]),
+        "complex" : (np.arange(4) + 1j*np.arange(4)[::-1]).reshape((2, 2)),
+        "text" : "hello",
+        "sparse" : scipy.sparse.csc_matrix(np.array([[0, 1.5, 0],
+          [2.5, 0, 0], [0, 0, -1]])),
+        "complex_sparse" : scipy.sparse.csc_matrix(np.array([[1j, 0],
+          [0, 2]])),
+        }
+
+  def check_value(self, expected, actual):
+    if scipy.sparse.issparse(expected):
+      self.assertTrue(scipy.sparse.issparse(actual))
+      self.assertEqual(expected.shape, actual.shape)
+      np.testing.assert_array_equal(expected.toarray(), actual.toarray())
+    elif isinstance(expected, basestring):
+      self.assertEqual(expected, actual)
+    else:
+      np.testing.assert_array_equal(expected, np.asarray(actual))
+      self.assertEqual(np.asarray(expected).dtype, np.asarray(actual).dtype)
+
+  def test_write_then_loadmat(self):
+    variables = self.variables()
+    matfile.write_mat(self.path, variables)
+    loaded = scipy.io.loadmat(self.path)
+    for (name, expected) in variables.items():
+      actual = loaded[name]
+      if isinstance(expected, basestring):
+        actual = actual[0]
+      elif expected.dtype == np.bool_:
+        # scipy doesn't keep the logical flag
+        actual = actual.astype(np.bool_)
+      self.check_value(expected, actual)
+
+  def test_savemat_then_read(self):
+    for compress in (False, True):
+      variables = self.variables()
+      scipy.io.savemat(self.path, variables, do_compression=compress)
+      loaded = matfile.read_mat(self.path)
+      for (name, expected) in variables.items():
+        self.check_value(expected, loaded[name])
+
+  def test_write_then_read(self):
+    variables = self.variables()
+    matfile.write_mat(self.path, variables)
+    for use_mmap in (True, False):
+      loaded = matfile.read_mat(self.path, use_mmap=use_mmap)
+      self.assertEqual(sorted(variables.keys()), sorted(loaded.keys()))
+      for (name, expected) in variables.items():
+        self.check_value(expected, loaded[name])
+
+  def test_mmap_views(self):
+    dense = np.arange(1000, dtype=np.double).reshape((10, 100))
+    matfile.write_mat(self.path, { "dense" : dense })
+    loaded = matfile.read_mat(self.path)["dense"]
+    np.testing.assert_array_equal(dense, loaded)
+    # a view of the map, not a copy
+    self.assertFalse(loaded.flags.owndata)
+    self.assertFalse(loaded.flags.writeable)
+
+  def test_scalars_and_vectors(self):
+    matfile.write_mat(self.path, { "scalar" : 2.5,
+      "vector" : np.arange(3.0) })
+    loaded = scipy.io.loadmat(self.path)
+    self.assertEqual((1, 1), loaded["scalar"].shape)
+    self.assertEqual((3, 1), loaded["vector"].shape)
+    loaded = matfile.read_mat(self.path)
+    self.assertEqual(2.5, loaded["scalar"])
+    np.testing.assert_array_equal(np.arange(3.0).reshape((3, 1)),
+        loaded["vector"])
+
+  def test_scalar_classes(self):
+    # numbers become doubles, as they do in engine.set_variable
+    matfile.write_mat(self.path, { "int" : 5, "int64" : np.int64(5),
+      "single" : np.float32(1.5), "complex" : np.complex64(1+2j),
+      "bool" : True })
+    loaded = matfile.read_mat(self.path)
+    self.assertEqual(np.double, type(loaded["int"]))
+    self.assertEqual(np.double, type(loaded["int64"]))
+    self.assertEqual(np.double, type(loaded["single"]))
+    self.assertEqual(np.complex128, type(loaded["complex"]))
+    self.assertEqual(np.bool_, type(loaded["bool"]))
+    loaded = scipy.io.loadmat(self.path)
+    self.assertEqual(np.double, loaded["int"].dtype)
+    self.assertEqual(np.double, loaded["int64"].dtype)
+    self.assertEqual(5.0, loaded["int64"][0, 0])
+
+  def test_char_matrix(self):
+    matfile.write_mat(self.path, { "names" : [ "alpha", "be" ] })
+    loaded = scipy.io.loadmat(self.path)
+    self.assertEqual([ u"alpha", u"be   " ], list(loaded["names"]))
+    loaded = matfile.read_mat(self.path)
+    self.assertEqual([ u"alpha", u"be" ], list(loaded["names"]))
+
+  def test_struct(self):
+    matfile.write_mat(self.path, { "s" : { "a" : 1.0,
+      "b" : np.arange(3.0), "c" : "text" } })
+    s = scipy.io.loadmat(self.path, squeeze_me=True)["s"]
+    self.assertEqual(1.0, s["a"][()])
+    np.testing.assert_array_equal(np.arange(3.0), s["b"][()])
+    self.assertEqual(u"text", s["c"][()])
+
+    scipy.io.savemat(self.path, { "s" : { "a" : 1.0, "c" : "text" } })
+    s = matfile.read_mat(self.path)["s"]
+    self.assertEqual({ "a" : 1.0, "c" : u"text" }, s)
+
+  def test_struct_array(self):
+    records = np.zeros((1, 2), dtype=[ ("x", object) ])
+    records[0, 0]["x"] = 1.0
+    records[0, 1]["x"] = 2.0
+    scipy.io.savemat(self.path, { "s" : records })
+    s = matfile.read_mat(self.path)["s"]
+    self.assertEqual((1, 2), s.shape)
+    self.assertEqual([ { "x" : 1.0 }, { "x" : 2.0 } ], list(s.flat))
+
+  def test_cell(self):
+    cell = np.empty((1, 3), dtype=object)
+    cell[0, 0] = 1.0
+    cell[0, 1] = "two"
+    cell[0, 2] = np.arange(3.0)
+    matfile.write_mat(self.path, { "c" : cell })
+    loaded = scipy.io.loadmat(self.path, squeeze_me=True)["c"]
+    self.assertEqual(1.0, loaded[0])
+    self.assertEqual(u"two", loaded[1])
+    np.testing.assert_array_equal(np.arange(3.0), loaded[2])
+
+    scipy.io.savemat(self.path, { "c" : cell })
+    loaded = matfile.read_mat(self.path)["c"]
+    self.assertEqual((1, 3), loaded.shape)
+    self.assertEqual(1.0, loaded[0, 0])
+    self.assertEqual(u"two", loaded[0, 1])
+    np.testing.assert_array_equal(np.arange(3.0).reshape((1, 3)),
+        loaded[0, 2])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,146 @@
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+  __file__))))
+import session_trace
+
+class session_trace_test(unittest.TestCase):
+  # traces are recorded here around a stand_in_backend, which does the
+  # same Python-side work as the engine without needing MATLAB
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp(prefix="matropylis_test")
+    self.path = os.path.join(self.directory, "session.trace")
+
+  def tearDown(self):
+    shutil.rmtree(self.directory, ignore_errors=True)
+
+  def record_session(self, payloads):
+    backend = session_trace.stand_in_backend()
+    recorder = session_trace.trace_recorder(self.path, payloads)
+    self.dense = np.arange(12.0).reshape((3, 4))
+    self.ints = np.arange(5, dtype=np.int32)
+    self.flags = np.array([True, False, True])
+    try:
+      recorder.record_eval(u"x = 1; % caf\xe9", backend.eval)
+      recorder.record_set("a", self.dense, backend.set_variable)
+      recorder.record_get("a", backend.get_variable)
+      recorder.record_set("f", len, backend.set_variable)
+      recorder.record_set_many({ "b" : self.ints, "c" : self.flags,
+        "d" : "text" }, backend.set_variables)
+      recorder.record_get_many([ "b", "c", "a" ], backend.get_variables)
+    finally:
+      recorder.close()
+
+  def test_records(self):
+    for payloads in (False, True):
+      self.record_session(payloads)
+      records = list(session_trace.read_trace(self.path))
+      self.assertEqual([ session_trace.EVAL, session_trace.SET,
+        session_trace.GET, session_trace.SET, session_trace.SET_MANY,
+        session_trace.GET_MANY ], [ r.op for r in records ])
+      for r in records:
+        self.assertTrue(r.start >= 0.0)
+        self.assertTrue(r.duration >= 0.0)
+
+      (ev, set_a, get_a, set_f, set_many, get_many) = records
+      self.assertEqual(u"x = 1; % caf\xe9", ev.subject)
+
+      self.assertEqual("a", set_a.subject)
+      self.assertEqual(np.dtype(np.double), set_a.dtype)
+      self.assertEqual((3, 4), set_a.shape)
+      self.assertEqual((3, 4), get_a.shape)
+      if payloads:
+        np.testing.assert_array_equal(self.dense, set_a.payload)
+        np.testing.assert_array_equal(self.dense, get_a.payload)
+      else:
+        self.assertTrue(set_a.payload is None)
+
+      # functions can't be described, only named
+      self.assertTrue(set_f.dtype is None)
+      self.assertEqual("builtin_function_or_method", set_f.type_name)
+
+      self.assertEqual(sorted([ "b", "c", "d" ]), sorted(set_many.subject))
+      described = dict(zip(set_many.subject, zip(set_many.dtype,
+        set_many.shape, set_many.payload)))
+      self.assertEqual((np.dtype(np.int32), (5,)), described["b"][:2])
+      self.assertEqual((np.dtype(np.bool_), (3,)), described["c"][:2])
+      self.assertEqual(np.dtype("S4"), described["d"][0])
+      if payloads:
+        np.testing.assert_array_equal(self.ints, described["b"][2])
+        np.testing.assert_array_equal(self.flags, described["c"][2])
+      else:
+        self.assertEqual((None, None, None), set_many.payload)
+
+      self.assertEqual(("b", "c", "a"), get_many.subject)
+      self.assertEqual(((5,), (3,), (3, 4)), get_many.shape)
+
+  def test_nested_operations(self):
+    # only the outermost operation is recorded
+    backend = session_trace.stand_in_backend()
+    recorder = session_trace.trace_recorder(self.path)
+    def set_through_eval(name, value):
+      recorder.record_eval("disp(1);", backend.eval)
+      backend.set_variable(name, value)
+    try:
+      recorder.record_set("a", np.zeros(3), set_through_eval)
+    finally:
+      recorder.close()
+    records = list(session_trace.read_trace(self.path))
+    self.assertEqual([ session_trace.SET ], [ r.op for r in records ])
+
+  def test_replay(self):
+    for payloads in (False, True):
+      self.record_session(payloads)
+      latencies = session_trace.recorded_latencies(self.path)
+      self.assertEqual(1, len(latencies["eval"]))
+      self.assertEqual(2, len(latencies["set"]))
+      self.assertEqual(1, len(latencies["set_many"]))
+      self.assertEqual(1, len(latencies["get_many"]))
+
+      backend = session_trace.stand_in_backend()
+      result = session_trace.replay_trace(self.path, backend)
+      self.assertEqual(0, result.errors)
+      # the function pushed to "f" couldn't be described
+      self.assertEqual(1, result.skipped)
+      self.assertEqual(1, len(result.latencies["eval"]))
+      self.assertEqual(1, len(result.latencies["set"]))
+      self.assertEqual(1, len(result.latencies["get"]))
+      self.assertEqual(1, len(result.latencies["set_many"]))
+      self.assertEqual(1, len(result.latencies["get_many"]))
+      self.assertEqual(sorted([ "a", "b", "c", "d" ]),
+          sorted(backend.workspace.keys()))
+      self.assertEqual((3, 4), backend.workspace["a"].shape)
+      if payloads:
+        np.testing.assert_array_equal(self.ints, backend.workspace["b"])
+        self.assertEqual("text", backend.workspace["d"][()])
+
+      summary = result.summary()
+      self.assertEqual(1, summary["set_many"]["count"])
+      self.assertTrue("get_many" in result.report())
+
+  def test_replay_expected_gets(self):
+    # a get of something only an eval made comes from the trace
+    backend = session_trace.stand_in_backend()
+    recorder = session_trace.trace_recorder(self.path, payloads=True)
+    backend.workspace["y"] = np.ones((2, 2))
+    try:
+      recorder.record_eval("y = ones(2);", backend.eval)
+      recorder.record_get_many([ "y" ], backend.get_variables)
+    finally:
+      recorder.close()
+
+    backend = session_trace.stand_in_backend()
+    result = session_trace.replay_trace(self.path, backend)
+    self.assertEqual(0, result.errors)
+    np.testing.assert_array_equal(np.ones((2, 2)), backend.workspace["y"])
+
+if __name__ == "__main__":
+  unittest.main()